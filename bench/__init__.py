@@ -0,0 +1,16 @@
+"""
+Benchmarks for onepop.
+
+    python -m bench seed --db bench.db --posts 2000      # build a synthetic forum
+    python -m bench run --db bench.db --duration 30      # hammer it, print a json report
+
+seed.py generates boards, users, posts and deep comment trees straight into
+a database file. workload.py drives the real routes with a mixed read/write
+workload, either in-process through the flask test client or over http
+against a running server (--url), and reports throughput and latency
+percentiles per route as json so runs can be compared.
+
+Writes go through popcap like any other client, so the app has to run with
+POPCAP_TEST_MODE = True and RATE_LIMITS = {}, every bench client comes from
+the same address (run does both itself when it runs in-process).
+"""
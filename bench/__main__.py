@@ -0,0 +1,71 @@
+import argparse
+import contextlib
+import json
+import sys
+
+from bench import seed, workload
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench", description="seed and benchmark onepop")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seeding = commands.add_parser("seed", help="add a synthetic forum to a database")
+    seeding.add_argument("--db", default="bench.db")
+    seeding.add_argument("--boards", type=int, default=8)
+    seeding.add_argument("--users", type=int, default=200)
+    seeding.add_argument("--posts", type=int, default=2000)
+    seeding.add_argument("--comments", type=int, default=40, help="average comments per post")
+    seeding.add_argument("--max-depth", type=int, default=16, help="deepest reply chain")
+    seeding.add_argument("--chain", type=float, default=0.5, help="chance a comment answers the previous one, higher is deeper")
+    seeding.add_argument("--seed", type=int, default=1)
+
+    running = commands.add_parser("run", help="drive the routes with a mixed workload, prints a json report")
+    running.add_argument("--db", default="bench.db", help="seeded database, also served in-process unless --url is given")
+    running.add_argument("--url", help="benchmark a running server (e.g. serve.py) on the same database instead")
+    running.add_argument("--mix", default=workload.DEFAULT_MIX, help=f"action weights, actions: {', '.join(workload.ACTIONS)}")
+    running.add_argument("--concurrency", type=int, default=8)
+    running.add_argument("--duration", type=float, default=30.0, help="seconds, not counting warmup")
+    running.add_argument("--requests", type=int, help="stop after this many actions")
+    running.add_argument("--warmup", type=float, default=2.0, help="seconds at the start that aren't measured")
+    running.add_argument("--logged-in", type=float, default=0.3, help="share of actions sent with a bench user's cookie")
+    running.add_argument("--hot-ratio", type=float, default=0.8, help="share of post views going to the newest 20%% of posts")
+    running.add_argument("--reply-ratio", type=float, default=0.7, help="share of new comments that reply to another comment")
+    running.add_argument("--captcha-solution", default="bench", help="the server's POPCAP_TEST_SOLUTION")
+    running.add_argument("--pool-size", type=int, default=8, help="sqlite connections of the in-process app")
+    running.add_argument("--seed", type=int, default=1)
+    running.add_argument("--output", help="write the report here instead of stdout")
+    args = parser.parse_args()
+
+    if args.command == "seed":
+        with contextlib.redirect_stdout(sys.stderr):
+            counts = seed.seed(args.db, boards=args.boards, users=args.users, posts=args.posts, comments=args.comments,
+                               max_depth=args.max_depth, chain=args.chain, seed=args.seed)
+        print(json.dumps(counts, indent=2))
+        return
+
+    # the app prints as it goes, keep stdout clean for the report
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.url:
+            make_client = lambda: workload.HTTPClient(args.url)
+            target = args.url
+        else:
+            from main import create_app
+            app = create_app({"DATABASE": args.db, "DB_POOL_SIZE": args.pool_size, "CAPTCHA_STORE": "memory",
+                              "POPCAP_TEST_MODE": True, "POPCAP_TEST_SOLUTION": args.captcha_solution,
+                              "RATE_LIMITS": {}})
+            make_client = lambda: workload.InProcessClient(app)
+            target = "in-process"
+
+        report = workload.run(make_client, args.db, mix=args.mix, concurrency=args.concurrency, duration=args.duration,
+                              requests=args.requests, warmup=args.warmup, logged_in=args.logged_in, hot_ratio=args.hot_ratio,
+                              reply_ratio=args.reply_ratio, captcha_solution=args.captcha_solution, seed=args.seed, target=target)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(workload.dumps(report))
+        print(f"bench: report written to {args.output}", file=sys.stderr)
+    else:
+        print(workload.dumps(report))
+
+if __name__ == "__main__":
+    main()
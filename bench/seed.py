@@ -0,0 +1,124 @@
+"""
+Synthetic forum generator. Fills a database with boards, users, posts and
+comment trees straight through sqlite, much faster than going through the
+routes. Comment ids are assigned here so paths, depths and reply counts can
+be computed without reading anything back.
+"""
+import random
+import time
+
+import helpers
+from database import Database
+
+WORDS = ("pop one forum board post thread reply question answer random sqlite flask python captcha "
+         "image proof work hash nonce token cookie cache index page window tree path depth search "
+         "fast slow latency throughput benchmark worker process connection pool query write read "
+         "the a of and to in is it that for on with as was at by this be are from or have not").split()
+
+BENCH_PASSWORD = "bench"
+
+def sentence(rng, low, high):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+def comment_tree(rng, count, max_depth, chain):
+    """
+    Shape of one post's comments: a list of parent indexes (None for top level),
+    parents always before their children.
+    chain: chance that a comment answers the one right before it, which makes deep threads
+    """
+    parents = []
+    depths = []
+    for i in range(count):
+        roll = rng.random()
+        if i == 0 or roll < 0.15:
+            parent = None
+        elif roll < 0.15 + chain:
+            parent = i - 1
+        else:
+            parent = rng.randrange(i)
+        if parent is not None and depths[parent] >= max_depth:
+            parent = None
+        parents.append(parent)
+        depths.append(0 if parent is None else depths[parent] + 1)
+    return parents
+
+def seed(filename, boards=8, users=200, posts=2000, comments=40, max_depth=16, chain=0.5, seed=1, batch=5000):
+    """
+    Add a synthetic forum to filename (created if needed).
+    comments: average comments per post, the actual count is random between 0 and twice that
+    Returns: dict of what was created
+    """
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    database = Database(filename, pool_size=1, captcha_image_pool=0)
+    now = helpers.timestamp()
+    password = helpers.hash(BENCH_PASSWORD)
+    counts = {"boards": 0, "users": 0, "posts": 0, "comments": 0, "max_depth": 0}
+
+    with database.handle() as (conn, cursor):
+        cursor.execute("SELECT (SELECT COALESCE(MAX(board_id), 0) FROM boards), (SELECT COALESCE(MAX(user_id), 0) FROM users)")
+        first_board, first_user = (value + 1 for value in cursor.fetchone())
+
+        cursor.executemany("INSERT INTO boards (board_id, name, description) VALUES (?, ?, ?)",
+                           [(first_board + i, f"bench{first_board + i}", sentence(rng, 3, 10)) for i in range(boards)])
+        counts["boards"] = boards
+        # posts go to the new boards, or the existing ones when no new boards were asked for
+        cursor.execute("SELECT board_id FROM boards WHERE board_id >= ? OR ? = 0", (first_board, boards))
+        board_ids = [row[0] for row in cursor.fetchall()]
+
+        # every bench user is logged in with a known cookie, so the workload can send it along
+        cursor.executemany("INSERT INTO users (user_id, username, password, cookie, role_id) VALUES (?, ?, ?, ?, 1)",
+                           [(first_user + i, f"bench_user_{first_user + i}", password, f"bench-cookie-{first_user + i}")
+                            for i in range(users)])
+        user_ids = [first_user + i for i in range(users)] or [None]
+        counts["users"] = users
+        conn.commit()
+
+    post_rows = []
+    comment_rows = []
+    with database.handle() as (conn, cursor):
+        cursor.execute("SELECT (SELECT COALESCE(MAX(post_id), 0) FROM posts), (SELECT COALESCE(MAX(comment_id), 0) FROM comments)")
+        post_id, comment_id = cursor.fetchone()
+
+        def flush():
+            cursor.executemany("""INSERT INTO posts (post_id, board_id, owner_id, title, description, image_url, created_at, updated_at)
+                                  VALUES (?, ?, ?, ?, ?, NULL, ?, ?)""", post_rows)
+            cursor.executemany("""INSERT INTO comments (comment_id, post_id, owner_id, parent_comment_id, content, created_at, updated_at,
+                                                        path, depth, reply_count)
+                                  VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", comment_rows)
+            conn.commit()
+            post_rows.clear()
+            comment_rows.clear()
+
+        for _ in range(posts):
+            post_id += 1
+            # spread over the last 30 days
+            created_at = now - rng.randint(0, 30 * 86400)
+            updated_at = created_at
+            rows = []
+            for parent in comment_tree(rng, rng.randint(0, comments * 2), max_depth, chain):
+                comment_id += 1
+                commented_at = min(now, created_at + rng.randint(0, 86400))
+                updated_at = max(updated_at, commented_at)
+                if parent is None:
+                    parent_id, path, depth = None, helpers.comment_path(None, comment_id), 0
+                else:
+                    parent_row = rows[parent]
+                    parent_row[9] += 1
+                    parent_id, path, depth = parent_row[0], helpers.comment_path(parent_row[7], comment_id), parent_row[8] + 1
+                rows.append([comment_id, post_id, rng.choice(user_ids), parent_id, sentence(rng, 3, 40),
+                             commented_at, commented_at, path, depth, 0])
+                counts["max_depth"] = max(counts["max_depth"], depth)
+            post_rows.append((post_id, rng.choice(board_ids), rng.choice(user_ids), sentence(rng, 2, 10).capitalize(),
+                              sentence(rng, 10, 120), created_at, updated_at))
+            comment_rows.extend(rows)
+            counts["posts"] += 1
+            counts["comments"] += len(rows)
+            if len(post_rows) + len(comment_rows) >= batch:
+                flush()
+        flush()
+        cursor.execute("PRAGMA optimize")
+
+    database.close()
+    counts["seconds"] = round(time.perf_counter() - started, 2)
+    return counts
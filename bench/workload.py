@@ -0,0 +1,263 @@
+"""
+Mixed read/write workload against the real routes, with per-route latency
+percentiles. Every worker thread picks actions by weight until the time or
+request budget runs out. A "comment" action is a whole popcap round trip
+(/popcap/wave1, /popcap/wave2, /create_comment), each request timed separately.
+"""
+import http.client
+import itertools
+import json
+import platform
+import random
+import sqlite3
+import subprocess
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+import helpers
+
+ACTIONS = ("index", "board", "post", "search", "comment")
+DEFAULT_MIX = "index=30,board=20,post=35,search=5,comment=10"
+
+def parse_mix(text):
+    """
+    "index=30,post=70" -> {"index": 30.0, "post": 70.0}
+    """
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in ACTIONS:
+            raise ValueError(f"Unknown action '{name}', expected one of {', '.join(ACTIONS)}")
+        mix[name] = float(weight)
+    if not any(weight > 0 for weight in mix.values()):
+        raise ValueError("The mix needs at least one action with a positive weight")
+    return mix
+
+def percentile(ordered, fraction):
+    # nearest rank on an already sorted list
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class InProcessClient():
+    """
+    Requests through the flask test client, no sockets involved.
+    Measures the app itself: routing, templates, sqlite.
+    """
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, form=None, cookie=None):
+        headers = {"Cookie": f"account={cookie}"} if cookie else {}
+        response = self.client.open(path, method=method, data=form, headers=headers)
+        return response.status_code, response.get_data(), response.headers
+
+class HTTPClient():
+    """
+    Requests over http to a running server, e.g. serve.py. Keeps the
+    connection open while the server allows it.
+    """
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.conn = None
+
+    def request(self, method, path, form=None, cookie=None):
+        headers = {"Cookie": f"account={cookie}"} if cookie else {}
+        body = None
+        if form is not None:
+            body = urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        for attempt in (1, 2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            try:
+                self.conn.request(method, path, body=body, headers=headers)
+                response = self.conn.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                # the server closed a kept-alive connection, retry once on a fresh one
+                self.conn.close()
+                self.conn = None
+                if attempt == 2:
+                    raise
+                continue
+            if response.will_close:
+                self.conn.close()
+                self.conn = None
+            return response.status, data, response.headers
+
+class Targets():
+    """
+    What the workload can ask for, read once from the database.
+    """
+    def __init__(self, filename, sample=20000, hot_fraction=0.2):
+        conn = sqlite3.connect(filename)
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM boards")
+        self.boards = [row[0] for row in cursor.fetchall()]
+        cursor.execute("SELECT post_id FROM posts ORDER BY updated_at DESC")
+        self.posts = [row[0] for row in cursor.fetchall()]
+        # replies go to a random sample of existing comments
+        cursor.execute("SELECT post_id, comment_id FROM comments WHERE path IS NOT NULL ORDER BY random() LIMIT ?", (sample,))
+        self.comments = cursor.fetchall()
+        cursor.execute("SELECT cookie FROM users WHERE cookie LIKE 'bench-cookie-%'")
+        self.cookies = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        if not self.boards or not self.posts:
+            raise RuntimeError(f"{filename} has no boards or posts, run `python -m bench seed` first")
+        # most traffic goes to the newest posts, like on a real front page
+        self.hot_posts = self.posts[:max(1, int(len(self.posts) * hot_fraction))]
+
+class Worker(threading.Thread):
+    def __init__(self, client, targets, mix, settings, deadline, budget, seed):
+        super().__init__(daemon=True)
+        self.client = client
+        self.targets = targets
+        self.actions = list(mix)
+        self.weights = [mix[action] for action in self.actions]
+        self.settings = settings
+        self.deadline = deadline
+        self.budget = budget
+        self.rng = random.Random(seed)
+        self.samples = {} # route -> [latency seconds]
+        self.errors = {} # route -> count
+        self.error_examples = {} # route -> first error
+
+    def timed(self, route, method, path, form=None, cookie=None, ok=(200,)):
+        started = time.perf_counter()
+        try:
+            status, body, headers = self.client.request(method, path, form=form, cookie=cookie)
+        except Exception as e:
+            status, body, headers = None, repr(e).encode(), {}
+        elapsed = time.perf_counter() - started
+        if started >= self.settings["warmup_until"]:
+            # the captcha routes answer errors with a 200 and a message
+            if status not in ok or body.startswith(b"Invalid captcha"):
+                self.errors[route] = self.errors.get(route, 0) + 1
+                self.error_examples.setdefault(route, f"{status}: {body[:200].decode(errors='replace')}")
+            else:
+                self.samples.setdefault(route, []).append(elapsed)
+        return status, body, headers
+
+    def pick_post(self):
+        if self.rng.random() < self.settings["hot_ratio"]:
+            return self.rng.choice(self.targets.hot_posts)
+        return self.rng.choice(self.targets.posts)
+
+    def cookie(self):
+        if self.targets.cookies and self.rng.random() < self.settings["logged_in"]:
+            return self.rng.choice(self.targets.cookies)
+        return None
+
+    def solve_pow(self, captcha_token, difficulty):
+        for nonce in itertools.count():
+            if helpers.check_pow(captcha_token, str(nonce), difficulty)[0]:
+                return str(nonce)
+
+    def do_index(self, cookie):
+        self.timed("/", "GET", "/", cookie=cookie)
+
+    def do_board(self, cookie):
+        self.timed("/board/<name>", "GET", f"/board/{self.rng.choice(self.targets.boards)}", cookie=cookie)
+
+    def do_post(self, cookie):
+        self.timed("/post/<id>", "GET", f"/post/{self.pick_post()}", cookie=cookie)
+
+    def do_search(self, cookie):
+        query = " ".join(self.rng.sample(self.settings["search_words"], self.rng.randint(1, 2)))
+        self.timed("/search", "GET", "/search?" + urlencode({"q": query}), cookie=cookie)
+
+    def do_comment(self, cookie):
+        status, body, headers = self.timed("/popcap/wave1", "GET", "/popcap/wave1")
+        if status != 200:
+            return
+        challenge = json.loads(body)
+        captcha_token = challenge["token"]
+        nonce = self.solve_pow(captcha_token, challenge["difficulty"])
+        status, body, headers = self.timed("/popcap/wave2", "GET", "/popcap/wave2?" + urlencode({"challenge_token": captcha_token, "nonce": nonce}))
+        if status != 200 or body.startswith(b"Invalid captcha"):
+            return
+        # signed captchas hand out a new token for the form here
+        captcha_token = headers.get("X-Popcap-Token") or captcha_token
+        if self.targets.comments and self.rng.random() < self.settings["reply_ratio"]:
+            post_id, parent_comment_id = self.rng.choice(self.targets.comments)
+        else:
+            post_id, parent_comment_id = self.pick_post(), ""
+        form = {"post_id": post_id, "parent_comment_id": parent_comment_id, "content": f"bench comment {self.rng.random()}",
+                "captcha_token": captcha_token, "captcha_input": self.settings["captcha_solution"]}
+        self.timed("/create_comment", "POST", "/create_comment", form=form, cookie=cookie, ok=(302,))
+
+    def run(self):
+        while time.perf_counter() < self.deadline and next(self.budget) > 0:
+            action = self.rng.choices(self.actions, self.weights)[0]
+            getattr(self, "do_" + action)(self.cookie())
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def run(make_client, filename, mix=DEFAULT_MIX, concurrency=8, duration=30.0, requests=None, warmup=2.0,
+        logged_in=0.3, hot_ratio=0.8, reply_ratio=0.7, captcha_solution="bench", seed=1, target=None):
+    """
+    Run the workload and return the report as a dict.
+    make_client: called once per worker thread, returns an object with request(method, path, form, cookie) -> (status, body, headers)
+    requests: stop after this many actions in total instead of (or before) duration
+    """
+    mix = parse_mix(mix) if isinstance(mix, str) else mix
+    targets = Targets(filename)
+    started = time.perf_counter()
+    settings = {"warmup_until": started + warmup, "logged_in": logged_in, "hot_ratio": hot_ratio, "reply_ratio": reply_ratio,
+                "captcha_solution": captcha_solution,
+                "search_words": ["forum", "sqlite", "captcha", "thread", "benchmark", "python", "latency", "window"]}
+    deadline = started + warmup + duration
+    budget = itertools.count(requests, -1) if requests else itertools.repeat(1)
+    workers = [Worker(make_client(), targets, mix, settings, deadline, budget, seed * 1000 + i) for i in range(concurrency)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    # with a request budget the run can end before the deadline
+    elapsed = max(time.perf_counter() - settings["warmup_until"], 1e-9)
+
+    routes = {}
+    for route in sorted({route for worker in workers for route in (*worker.samples, *worker.errors)}):
+        latencies = sorted(sample for worker in workers for sample in worker.samples.get(route, ()))
+        errors = sum(worker.errors.get(route, 0) for worker in workers)
+        ms = lambda value: round(value * 1000, 3) if value is not None else None
+        routes[route] = {
+            "count": len(latencies),
+            "errors": errors,
+            "rps": round(len(latencies) / elapsed, 2),
+            "mean_ms": ms(sum(latencies) / len(latencies)) if latencies else None,
+            "p50_ms": ms(percentile(latencies, 0.50)),
+            "p95_ms": ms(percentile(latencies, 0.95)),
+            "p99_ms": ms(percentile(latencies, 0.99)),
+            "max_ms": ms(latencies[-1]) if latencies else None,
+        }
+        example = next((worker.error_examples[route] for worker in workers if route in worker.error_examples), None)
+        if example:
+            routes[route]["first_error"] = example
+
+    total = sum(route["count"] for route in routes.values())
+    return {
+        "target": target,
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "started_at": helpers.timestamp(),
+        "settings": {"mix": mix, "concurrency": concurrency, "duration": duration, "requests": requests, "warmup": warmup,
+                     "logged_in": logged_in, "hot_ratio": hot_ratio, "reply_ratio": reply_ratio, "seed": seed},
+        "dataset": {"boards": len(targets.boards), "posts": len(targets.posts)},
+        "seconds": round(elapsed, 3),
+        "requests": total,
+        "errors": sum(route["errors"] for route in routes.values()),
+        "throughput_rps": round(total / elapsed, 2),
+        "routes": routes,
+    }
+
+def dumps(report):
+    return json.dumps(report, indent=2)
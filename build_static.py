@@ -0,0 +1,117 @@
+"""
+Build the static assets for production.
+
+    python build_static.py [--tailwind "npx @tailwindcss/cli"]
+
+Compiles templates/styles.css with the Tailwind CLI into one minified css file
+that only has the classes the templates use, then writes it and popcap.js to
+static/build under content hashed names (onepop.<hash>.css) together with
+precompressed .gz copies (and .br ones if the brotli package is installed).
+static/build/manifest.json maps the plain names to the hashed ones, main.py
+serves those from /assets/ with immutable caching.
+
+Without a build, the pages fall back to compiling the styles in the browser
+with static/tailwind.js. Rebuild after changing templates or popcap.js, both
+are scanned for class names (see CSS_SOURCES).
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+TEMPLATES = os.path.join(ROOT, "templates")
+STATIC = os.path.join(ROOT, "static")
+BUILD = os.path.join(STATIC, "build")
+# everything tailwind has to scan for class names. popcap.js adds some with classList,
+# tailwind.js itself is left out, it would drag in every class name it knows
+CSS_SOURCES = (TEMPLATES, os.path.join(STATIC, "popcap.js"))
+
+def tailwind_input():
+    """
+    Returns: the input for the Tailwind CLI, templates/styles.css plus what the cli has to be told
+    """
+    with open(os.path.join(TEMPLATES, "styles.css")) as f:
+        styles = f.read()
+    # the browser runtime adds tailwind itself and looks at the live page,
+    # the cli needs the import and every file that uses classes
+    sources = "".join(f'@source "{path}";\n' for path in CSS_SOURCES)
+    return '@import "tailwindcss";\n' + sources + styles
+
+def compile_css(tailwind):
+    """
+    Run the Tailwind CLI over templates/styles.css.
+    Returns: the minified css as bytes
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, "input.css")
+        output = os.path.join(tmp, "output.css")
+        with open(source, "w") as f:
+            f.write(tailwind_input())
+        command = shlex.split(tailwind) + ["-i", source, "-o", output, "--minify"]
+        print(f"build: {' '.join(command)}")
+        subprocess.run(command, check=True, cwd=ROOT)
+        with open(output, "rb") as f:
+            return f.read()
+
+def write_asset(name, data):
+    """
+    Write data as static/build/<stem>.<hash><ext> plus compressed copies.
+    Returns: the hashed file name
+    """
+    stem, ext = os.path.splitext(name)
+    hashed = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+    path = os.path.join(BUILD, hashed)
+    with open(path, "wb") as f:
+        f.write(data)
+    # mtime=0 so the same input always gives the same .gz
+    with open(path + ".gz", "wb") as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    sizes = f"{len(data)} bytes, gzip {os.path.getsize(path + '.gz')}"
+    if brotli is not None:
+        with open(path + ".br", "wb") as f:
+            f.write(brotli.compress(data, quality=11))
+        sizes += f", brotli {os.path.getsize(path + '.br')}"
+    print(f"build: {name} -> {hashed} ({sizes})")
+    return hashed
+
+def main():
+    parser = argparse.ArgumentParser(description="build fingerprinted, precompressed static assets into static/build")
+    parser.add_argument("--tailwind", default="npx @tailwindcss/cli", help="command that runs the Tailwind v4 CLI")
+    args = parser.parse_args()
+
+    try:
+        css = compile_css(args.tailwind)
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"build: tailwind failed: {e}")
+        return 1
+    with open(os.path.join(STATIC, "popcap.js"), "rb") as f:
+        popcap = f.read()
+
+    # start clean so old hashes don't pile up
+    shutil.rmtree(BUILD, ignore_errors=True)
+    os.makedirs(BUILD)
+    manifest = {
+        "onepop.css": write_asset("onepop.css", css),
+        "popcap.js": write_asset("popcap.js", popcap),
+    }
+    with open(os.path.join(BUILD, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    if brotli is None:
+        print("build: brotli isn't installed, only wrote gzip copies (pip install brotli)")
+    print("build: done, restart onepop to pick up the new manifest")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
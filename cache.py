@@ -0,0 +1,93 @@
+import threading
+import time
+from collections import OrderedDict
+
+class LRUCache():
+    """
+    Small thread-safe LRU cache with an optional time to live.
+    maxsize: entries kept before the least recently used one is dropped
+    ttl: seconds an entry stays valid, None for forever
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (expires_at, value)
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+class PageCache():
+    """
+    Rendered page fragments per board (None for the front page) and variant
+    (e.g. the paging cursor). Invalidating a board bumps its generation, which
+    changes the keys of all its fragments, so stale ones are never looked up
+    again and simply age out of the LRU. The front page shows every board, so
+    it is invalidated along with any of them.
+
+    With several server processes, pass a multiprocessing.Value as
+    shared_generation: every invalidation bumps it, and it is part of every
+    key, so a write in one process invalidates all pages in all processes.
+    """
+    def __init__(self, maxsize=512, ttl=60, shared_generation=None):
+        # ttl keeps the "x minutes ago" strings inside the fragments from going stale for long
+        self.fragments = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.generations = {} # board -> int
+        self.shared_generation = shared_generation
+        self.lock = threading.Lock()
+
+    def key(self, board, variant):
+        """
+        Compute the key before querying the data you're going to render, so a
+        write that lands in between invalidates the fragment you're about to store.
+        """
+        shared = self.shared_generation.value if self.shared_generation is not None else 0
+        return (board, self.generations.get(board, 0), shared, variant)
+
+    def get(self, key):
+        return self.fragments.get(key)
+
+    def set(self, key, fragment):
+        self.fragments.set(key, fragment)
+
+    def invalidate(self, board):
+        with self.lock:
+            self.generations[board] = self.generations.get(board, 0) + 1
+            self.generations[None] = self.generations.get(None, 0) + 1
+        if self.shared_generation is not None:
+            with self.shared_generation.get_lock():
+                self.shared_generation.value += 1
+
+    def clear(self):
+        self.fragments.clear()
+        if self.shared_generation is not None:
+            with self.shared_generation.get_lock():
+                self.shared_generation.value += 1
@@ -0,0 +1,345 @@
+"""
+Storage backends for in-flight popcap captchas.
+
+A captcha record is (created_at, wave, wave_two_solution, difficulty) keyed by its token.
+Both stores have the same methods so Database doesn't care which one it got:
+    create(captcha_token, created_at, wave_two_solution, difficulty)
+    get(captcha_token) -> (created_at, wave, wave_two_solution, difficulty) or None
+    set_wave(captcha_token, wave)
+    delete(captcha_token)
+    take(captcha_token) -> the record or None, removing it in the same step
+    expire(now)
+
+CAPTCHA_STORE = "signed" doesn't use a store at all, see CaptchaSigner.
+
+CaptchaImagePool pre-renders the wave 2 images handed out with new captchas.
+DifficultyController picks the wave 1 difficulty of every new captcha.
+"""
+import base64
+import hashlib
+import hmac
+import math
+import queue
+import threading
+import string
+import time
+from collections import deque
+import helpers
+
+CAPTCHA_TTL = 600 # seconds a captcha stays valid after being issued
+
+class MemoryCaptchaStore():
+    """
+    Captchas in a dict, expired through a timer wheel of one-second slots.
+    Lookups are O(1) and expiring only ever looks at the oldest slots, so the
+    cost is amortized over the captchas issued. Only valid within one process.
+    """
+    def __init__(self, ttl=CAPTCHA_TTL):
+        self.ttl = ttl
+        self.records = {} # token -> [created_at, wave, wave_two_solution, difficulty]
+        self.wheel = deque() # (created_at, [tokens]) oldest first
+        self.lock = threading.Lock()
+
+    def create(self, captcha_token, created_at, wave_two_solution, difficulty):
+        with self.lock:
+            self.records[captcha_token] = [created_at, 1, wave_two_solution, difficulty]
+            if self.wheel and self.wheel[-1][0] == created_at:
+                self.wheel[-1][1].append(captcha_token)
+            else:
+                self.wheel.append((created_at, [captcha_token]))
+
+    def get(self, captcha_token):
+        record = self.records.get(captcha_token)
+        return tuple(record) if record else None
+
+    def set_wave(self, captcha_token, wave):
+        with self.lock:
+            record = self.records.get(captcha_token)
+            if record:
+                record[1] = wave
+
+    def delete(self, captcha_token):
+        with self.lock:
+            self.records.pop(captcha_token, None)
+
+    def take(self, captcha_token):
+        # under the lock, so two requests with the same token can't both get it
+        with self.lock:
+            record = self.records.pop(captcha_token, None)
+        return tuple(record) if record else None
+
+    def expire(self, now):
+        threshold = now - self.ttl
+        with self.lock:
+            while self.wheel and self.wheel[0][0] < threshold:
+                for captcha_token in self.wheel.popleft()[1]:
+                    self.records.pop(captcha_token, None)
+
+class SQLiteCaptchaStore():
+    """
+    Captchas in the captchas table. Slower and competes with posts for the
+    write lock, but works when several processes serve the same database.
+    """
+    def __init__(self, database, ttl=CAPTCHA_TTL, purge_interval=30):
+        self.database = database
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self.last_purge = 0
+
+    def create(self, captcha_token, created_at, wave_two_solution, difficulty):
+        self.database.writer.submit(lambda cursor: cursor.execute(
+            "INSERT INTO captchas (captcha_token, created_at, wave, wave_two_solution, difficulty) VALUES (?, ?, ?, ?, ?)",
+            (captcha_token, created_at, 1, wave_two_solution, difficulty)))
+
+    def get(self, captcha_token):
+        with self.database.handle() as (conn, cursor):
+            cursor.execute("SELECT created_at, wave, wave_two_solution, difficulty FROM captchas WHERE captcha_token = ?", (captcha_token,))
+            return cursor.fetchone()
+
+    def set_wave(self, captcha_token, wave):
+        self.database.writer.submit(lambda cursor: cursor.execute("UPDATE captchas SET wave = ? WHERE captcha_token = ?", (wave, captcha_token)))
+
+    def delete(self, captcha_token):
+        self.database.writer.submit(lambda cursor: cursor.execute("DELETE FROM captchas WHERE captcha_token = ?", (captcha_token,)))
+
+    def take(self, captcha_token):
+        # one statement on the single writer: only one request can delete the row and get it back
+        def write(cursor):
+            cursor.execute("""DELETE FROM captchas WHERE captcha_token = ?
+                              RETURNING created_at, wave, wave_two_solution, difficulty""", (captcha_token,))
+            return cursor.fetchone()
+        return self.database.writer.submit(write)
+
+    def expire(self, now):
+        # expired captchas are rejected on read anyway, so the purge doesn't have to run every time
+        if now - self.last_purge < self.purge_interval:
+            return
+        self.last_purge = now
+        self.database.writer.submit(lambda cursor: cursor.execute("DELETE FROM captchas WHERE created_at < ?", (now - self.ttl,)))
+
+class SpentTokens():
+    """
+    Ids of captchas that were used up, one set per ttl-long bucket of issue
+    times. A captcha is only valid for ttl after it was issued, so once the
+    clock is past the bucket after a captcha's own, nothing in that bucket can
+    be checked again and the whole set is dropped. Memory stays bounded by the
+    captchas issued in about two ttls.
+    """
+    def __init__(self, ttl=CAPTCHA_TTL):
+        self.ttl = ttl
+        self.buckets = {} # issued_at // ttl -> set of captcha ids
+        self.lock = threading.Lock()
+
+    def spend(self, captcha_id, issued_at, now):
+        """
+        Returns: True the first time a captcha is spent, False if it was already
+        """
+        with self.lock:
+            oldest = now // self.ttl - 1
+            for bucket in [bucket for bucket in self.buckets if bucket < oldest]:
+                del self.buckets[bucket]
+            spent = self.buckets.setdefault(issued_at // self.ttl, set())
+            if captcha_id in spent:
+                return False
+            spent.add(captcha_id)
+            return True
+
+class SQLiteSpentTokens():
+    """
+    SpentTokens in the captcha_spent table, so every process serving the
+    database sees the same spent ids. Same buckets, the old ones are purged
+    once the clock has moved past them. Costs a write for every spent
+    captcha, so it's only used with CAPTCHA_SHARED_SPENT.
+    """
+    def __init__(self, database, ttl=CAPTCHA_TTL):
+        self.database = database
+        self.ttl = ttl
+        self.purged_below = 0
+
+    def spend(self, captcha_id, issued_at, now):
+        """
+        Returns: True the first time a captcha is spent, False if it was already
+        """
+        oldest = now // self.ttl - 1
+        purge = oldest > self.purged_below
+        def write(cursor):
+            if purge:
+                cursor.execute("DELETE FROM captcha_spent WHERE bucket < ?", (oldest,))
+            # the primary key decides, on the single writer of whichever process gets there first
+            cursor.execute("INSERT OR IGNORE INTO captcha_spent (captcha_id, bucket) VALUES (?, ?)",
+                           (captcha_id, issued_at // self.ttl))
+            return cursor.rowcount == 1
+        spent = self.database.writer.submit(write)
+        if purge:
+            self.purged_below = oldest
+        return spent
+
+class CaptchaSigner():
+    """
+    Stateless captchas. Everything about a captcha travels in its token,
+    "<wave>.<captcha id>.<issued_at>.<difficulty>.<signature>", signed with
+    HMAC-SHA256 under the secret key, so checking one is pure cpu work.
+    The wave 2 solution isn't stored anywhere either: it is derived from the
+    key and the captcha id, so any process with the key can draw and check it.
+    Passing wave 1 gets a wave 2 token for the same captcha id, and using that
+    on a form spends the id for good (see SpentTokens).
+    fixed_solution: wave 2 solution of every captcha (test mode)
+    spent: where spent ids are kept, SpentTokens of this process by default, which
+           only blocks replays in this process. SQLiteSpentTokens shares them (CAPTCHA_SHARED_SPENT)
+    """
+    SOLUTION_ALPHABET = string.ascii_letters + string.digits
+
+    def __init__(self, secret, ttl=CAPTCHA_TTL, fixed_solution=None, spent=None):
+        if not secret:
+            raise ValueError("signed captchas need a SECRET_KEY")
+        self.key = secret.encode() if isinstance(secret, str) else secret
+        self.ttl = ttl
+        self.fixed_solution = fixed_solution
+        self.spent = spent if spent is not None else SpentTokens(ttl)
+
+    def mac(self, purpose, message):
+        # one key, different purposes can never produce each other's values
+        return hmac.new(self.key, f"popcap.{purpose}.{message}".encode(), hashlib.sha256).digest()
+
+    def issue(self, captcha_id, issued_at, difficulty, wave=1):
+        body = f"{wave}.{captcha_id}.{issued_at}.{difficulty}"
+        signature = base64.urlsafe_b64encode(self.mac("token", body)[:18]).decode()
+        return f"{body}.{signature}"
+
+    def verify(self, token, wave, now):
+        """
+        Returns: (captcha_id, issued_at, difficulty), or None if the token is forged,
+        malformed, expired or for the other wave
+        """
+        if not token or len(token) > 256:
+            return None
+        body, _, signature = token.rpartition(".")
+        expected = base64.urlsafe_b64encode(self.mac("token", body)[:18]).decode()
+        if not hmac.compare_digest(signature.encode(), expected.encode()):
+            return None
+        token_wave, captcha_id, issued_at, difficulty = body.split(".")
+        issued_at, difficulty = int(issued_at), int(difficulty)
+        if token_wave != str(wave) or issued_at < now - self.ttl:
+            return None
+        return captcha_id, issued_at, difficulty
+
+    def solution(self, captcha_id):
+        if self.fixed_solution:
+            return self.fixed_solution
+        digest = self.mac("solution", captcha_id)
+        return "".join(self.SOLUTION_ALPHABET[byte % len(self.SOLUTION_ALPHABET)] for byte in digest[:5])
+
+class CaptchaImagePool():
+    """
+    Renders wave 2 images ahead of time on a background thread, so issuing a
+    captcha just takes a finished (captcha_id, wave_two_solution, png_bytes).
+    Falls back to rendering inline when the pool runs dry or size is 0.
+    solution_for: captcha_id -> wave 2 solution, a random code by default
+    fixed_solution: draw this text on every image instead (test mode)
+    """
+    def __init__(self, size=64, fixed_solution=None, solution_for=None):
+        self.size = size
+        self.fixed_solution = fixed_solution
+        self.solution_for = solution_for
+        self.ready = queue.Queue(maxsize=max(size, 1))
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def render(self):
+        captcha_id = helpers.generate_uuid()
+        if self.fixed_solution:
+            wave_two_solution = self.fixed_solution
+        elif self.solution_for is not None:
+            wave_two_solution = self.solution_for(captcha_id)
+        else:
+            wave_two_solution = helpers.generate_short_code()
+        return captcha_id, wave_two_solution, helpers.create_captcha_image(wave_two_solution)
+
+    def fill(self):
+        while True:
+            self.ready.put(self.render())
+
+    def start(self):
+        # started on first use rather than in __init__, so every forked server process gets its own thread
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.fill, name="popcap-images", daemon=True)
+                self.thread.start()
+
+    def take(self):
+        if self.size <= 0:
+            return self.render()
+        self.start()
+        try:
+            return self.ready.get_nowait()
+        except queue.Empty:
+            return self.render()
+
+class RateMeter():
+    """
+    Events per second, averaged with an exponential decay so old bursts fade out.
+    half_life: seconds after which an event counts half
+    """
+    def __init__(self, half_life=30):
+        self.half_life = half_life
+        self.value = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def decay(self, now):
+        self.value *= 0.5 ** ((now - self.updated) / self.half_life)
+        self.updated = now
+
+    def add(self, count=1):
+        with self.lock:
+            self.decay(time.monotonic())
+            self.value += count
+
+    def rate(self):
+        with self.lock:
+            self.decay(time.monotonic())
+            # the decayed sum of a steady stream of r events per second is r * half_life / ln 2
+            return self.value * math.log(2) / self.half_life
+
+class DifficultyController():
+    """
+    Picks the wave 1 difficulty (leading zero bits) for new captchas from how
+    busy this process is. Quiet: base. Every time the captcha rate or the
+    write rate doubles past what counts as busy, one more bit, which doubles
+    the work a client has to do for its next captcha. Spam waves pay for
+    themselves instead of landing on the write path, and it drops back on
+    its own once they stop.
+    base: difficulty when it's quiet
+    maximum: never ask more than this
+    busy_captchas: captchas issued per second above which it gets harder
+    busy_writes: posts, comments and signups per second above which it gets harder
+    """
+    def __init__(self, base=16, maximum=22, busy_captchas=2, busy_writes=1, half_life=30):
+        self.base = base
+        self.maximum = max(base, maximum)
+        self.busy_captchas = busy_captchas
+        self.busy_writes = busy_writes
+        self.captchas = RateMeter(half_life)
+        self.writes = RateMeter(half_life)
+
+    def captcha_issued(self):
+        self.captchas.add()
+
+    def write(self):
+        self.writes.add()
+
+    def difficulty(self):
+        if self.maximum == self.base:
+            return self.base
+        load = max(self.captchas.rate() / self.busy_captchas, self.writes.rate() / self.busy_writes)
+        extra = math.ceil(math.log2(load)) if load > 1 else 0
+        return min(self.base + extra, self.maximum)
+
+def make_store(kind, database):
+    if kind == "signed":
+        return None # nothing to store
+    if kind == "memory":
+        return MemoryCaptchaStore()
+    if kind == "sqlite":
+        return SQLiteCaptchaStore(database)
+    raise ValueError(f"Unknown captcha store '{kind}', expected 'memory', 'sqlite' or 'signed'")
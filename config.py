@@ -0,0 +1,69 @@
+# onepop settings
+
+# sqlite database file
+DATABASE = "onepop.db"
+# pooled sqlite connections kept open per server process
+DB_POOL_SIZE = 8
+# upgrade the schema on startup. serve.py does this once before starting its workers
+MIGRATE = True
+
+# where to listen, used by serve.py and `python main.py`
+HOST = "0.0.0.0"
+PORT = 8080
+# server processes started by serve.py, 0 means one per cpu core
+WORKERS = 0
+
+# where popcap keeps captchas between the waves:
+# "memory" - dict in the server process, no database writes. Only works with a single server process,
+#            serve.py switches to "sqlite" when it runs more than one worker.
+# "sqlite" - the captchas table in DATABASE
+# "signed" - nothing stored: tokens are signed with SECRET_KEY and checked with cpu work only, and the wave 2
+#            answer is derived from the key. Used up captchas are only remembered by the process that saw them,
+#            so with serve.py a solved captcha can be used once per worker (within CAPTCHA_TTL), unless
+#            CAPTCHA_SHARED_SPENT is on.
+CAPTCHA_STORE = "memory"
+# signs popcap tokens with CAPTCHA_STORE = "signed". Keep it secret, anyone who knows it can make captchas
+# that solve themselves. None makes a random one on every start
+SECRET_KEY = None
+
+# with CAPTCHA_STORE = "signed" and more than one serve.py worker: write used up captchas to the database
+# (captcha_spent) so every worker refuses them. Closes the once per worker replay, at the price of a
+# write and commit for every form that is sent. serve.py ignores it with a single worker
+CAPTCHA_SHARED_SPENT = False
+
+# number of wave 2 images rendered ahead of time in the background, 0 renders them on demand
+CAPTCHA_IMAGE_POOL = 64
+
+# wave 1 proof of work difficulty in leading zero bits of sha256, every bit doubles the work.
+# POPCAP_DIFFICULTY is asked while the server is quiet, one bit more every time the rate of captchas
+# or of writes (posts, comments, signups) per server process doubles past POPCAP_BUSY_CAPTCHAS or
+# POPCAP_BUSY_WRITES per second, up to POPCAP_MAX_DIFFICULTY
+POPCAP_DIFFICULTY = 16
+POPCAP_MAX_DIFFICULTY = 22
+POPCAP_BUSY_CAPTCHAS = 2
+POPCAP_BUSY_WRITES = 1
+
+# popcap test mode for benchmarks and tests, NEVER enable this on a public server:
+# wave 1 accepts any nonce and every wave 2 image shows POPCAP_TEST_SOLUTION
+POPCAP_TEST_MODE = False
+POPCAP_TEST_SOLUTION = "bench"
+
+# record request, sql and popcap metrics and serve them on /metrics (Prometheus text format)
+METRICS = True
+# log sql statements slower than this many milliseconds with the types of their parameters, None to turn off
+SLOW_QUERY_MS = None
+
+# per client rate limits, see ratelimit.py: group -> (requests per minute, burst), None turns a group off.
+# clients over the limit get 429 before any database work. popcap counts both waves of every captcha.
+RATE_LIMITS = {
+    "popcap": (60, 20),
+    "create_post": (5, 3),
+    "create_comment": (20, 5),
+    "login": (10, 5),
+    "signup": (3, 3),
+}
+# clients tracked per server process before idle ones are forgotten
+RATE_LIMIT_CLIENTS = 100000
+# reverse proxies in front of onepop that add X-Forwarded-For. Without this behind a proxy
+# every request comes from the proxy's address and shares one bucket
+TRUSTED_PROXIES = 0
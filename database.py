@@ -1,211 +1,304 @@
 import sqlite3
+import hmac
 import helpers
-import hashlib
+import migrations
+import captcha
+import metrics
+import time
+import queue
+import zlib
+from collections import namedtuple
+from contextlib import contextmanager
+from cache import LRUCache, PageCache
+from writer import Writer
+from models import Post, Comment, SearchResult
+
+Session = namedtuple("Session", ["user_id", "username", "role"])
+NO_SESSION = object() # cache miss marker, None is a valid cached value (unknown cookie)
+# everything view_post renders, see Database.load_post_page
+PostPage = namedtuple("PostPage", ["post", "comments", "next_after", "replying_to", "session"])
+
+class ConnectionPool():
+    """
+    Keeps long-lived sqlite connections around so a request doesn't pay for
+    connect() and the pragmas on every query. Connections are handed out by
+    Database.handle() and always come back here when the with-block ends.
+    """
+    def __init__(self, filename: str, size=8, busy_timeout=5.0, cache_kib=16384, mmap_bytes=256 * 1024 * 1024):
+        self.filename = filename
+        self.busy_timeout = busy_timeout
+        self.cache_kib = cache_kib
+        self.mmap_bytes = mmap_bytes
+        # LIFO so the hottest connection (warm page cache) gets reused first
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def connect(self):
+        # timeout= is sqlite's busy timeout: wait for a writer instead of failing with "database is locked"
+        conn = sqlite3.connect(self.filename, timeout=self.busy_timeout, check_same_thread=False)
+        conn.execute("PRAGMA foreign_keys = ON")
+        # WAL only needs an fsync at checkpoints with synchronous=NORMAL and is still crash safe
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{int(self.cache_kib)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_bytes)}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return self.connect()
+
+    def release(self, conn):
+        # never hand out a connection with a half finished transaction
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+class BoardRegistry():
+    """
+    Read-only snapshot of the boards table. Boards almost never change, so
+    routes resolve them from memory instead of asking sqlite every request.
+    Never mutated after creation: Database swaps in a new one on changes.
+    """
+    def __init__(self, rows):
+        # rows: (board_id, name, description) ordered by board_id
+        self.names = tuple(row[1] for row in rows)
+        self.ids = {row[1]: row[0] for row in rows}
+        self.names_by_id = {row[0]: row[1] for row in rows}
+        self.descriptions = {row[1]: row[2] for row in rows}
+        # changes whenever a board is added, renamed or described differently, the same in every process
+        self.version = zlib.crc32(repr(rows).encode())
 
 class Database():
     FILE = ""
-    def __init__(self, filename: str):
+    def __init__(self, filename: str, pool_size=8, captcha_store="memory", captcha_image_pool=64, migrate=True, page_generation=None,
+                 captcha_difficulty=16, captcha_max_difficulty=22, captcha_busy_captchas=2, captcha_busy_writes=1,
+                 captcha_test_solution=None, secret_key=None, captcha_shared_spent=False):
+        """
+        migrate: upgrade the schema and seed a fresh database. With False the schema
+                 only has to be current already (e.g. the parent process of serve.py did it)
+        page_generation: shared counter to invalidate the page caches of other processes, see PageCache
+        captcha_difficulty: wave 1 proof of work difficulty in leading zero bits when the server is quiet
+        captcha_max_difficulty, captcha_busy_captchas, captcha_busy_writes: how far and when it rises, see captcha.DifficultyController
+        captcha_test_solution: give every captcha this wave 2 solution (test mode only)
+        secret_key: signs the tokens with captcha_store="signed"
+        captcha_shared_spent: keep spent signed captchas in the database for all processes instead of this one's memory
+        """
         self.FILE = filename
-        print("db: setupdb - Creating/Updating tables")
-        conn, cursor = self.handle()
-
-        # roles table for permission management
-        # ID, Name (e.g., 'user', 'moderator', 'admin')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS roles (
-                    role_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT UNIQUE NOT NULL
-                )''')
-
-        # boards table for categorizing posts
-        # ID, Name, Description
-        # Note: Simple independent boards. If a hierarchy is needed, add a parent_board_id
-        cursor.execute('''CREATE TABLE IF NOT EXISTS boards (
-                    board_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    name TEXT UNIQUE NOT NULL,
-                    description TEXT
-                )''')
-
-        # users table
-        # Added role_id foreign key
-        cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    password TEXT NOT NULL, -- Should store password hash
-                    cookie TEXT UNIQUE, -- For remember me functionality, optional
-                    role_id INTEGER DEFAULT 1, -- Default role_id, e.g., 1 for 'user'
-                    FOREIGN KEY (role_id) REFERENCES roles (role_id)
-                )''')
-
-        # posts table
-        # Changed board TEXT to board_id INTEGER FOREIGN KEY
-        # Removed Reputation (JSON) and Lastrep
-        # Added total_upvotes for quick access
-        cursor.execute('''CREATE TABLE IF NOT EXISTS posts (
-                    post_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    board_id INTEGER NOT NULL, -- Link to the boards table
-                    owner_id INTEGER, -- Link to the users table (can be NULL for anonymous)
-                    title TEXT,
-                    description TEXT, -- Or content for the main post body
-                    image_url TEXT, -- Added field for image URL/path
-                    created_at INTEGER NOT NULL,
-                    updated_at INTEGER NOT NULL, -- To track last activity
-                    FOREIGN KEY (board_id) REFERENCES boards (board_id),
-                    FOREIGN KEY (owner_id) REFERENCES users (user_id)
-                )''')
-                
-        # Note: You might want a separate table for post images if multiple images per post are allowed.
-
-        # comments table
-        cursor.execute('''CREATE TABLE IF NOT EXISTS comments (
-                    comment_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    post_id INTEGER NOT NULL, -- Link to the posts table
-                    owner_id INTEGER, -- Link to the users table (can be NULL for anonymous)
-                    parent_comment_id INTEGER, -- Link to parent comment for threading
-                    content TEXT NOT NULL,
-                    created_at INTEGER NOT NULL,
-                    updated_at INTEGER NOT NULL, -- To track last activity
-                    FOREIGN KEY (post_id) REFERENCES posts (post_id),
-                    FOREIGN KEY (owner_id) REFERENCES users (user_id),
-                    FOREIGN KEY (parent_comment_id) REFERENCES comments (comment_id)
-                )''')
-
-        # for captchas
-        cursor.execute('''CREATE TABLE IF NOT EXISTS captchas (
-                    captcha_id INTEGER PRIMARY KEY AUTOINCREMENT, 
-                    captcha_token TEXT NOT NULL,
-                    created_at INTEGER NOT NULL,
-                    wave INTEGER NOT NULL,
-                    wave_two_solution TEXT NOT NULL
-                )''')
-
-
-        conn.commit()
-        print("db: Tables checked/created successfully.")
-        conn.close()
+        self.pool = ConnectionPool(filename, size=pool_size)
+        # every write goes through here, see writer.py
+        self.writer = Writer(self.pool.connect)
+        self.captchas = captcha.make_store(captcha_store, self)
+        self.captcha_signer = None
+        if captcha_store == "signed":
+            # spent ids stay in memory unless asked for, checking a captcha shouldn't cost a commit
+            spent = captcha.SQLiteSpentTokens(self) if captcha_shared_spent else None
+            self.captcha_signer = captcha.CaptchaSigner(secret_key, fixed_solution=captcha_test_solution, spent=spent)
+        self.captcha_pool = captcha.CaptchaImagePool(size=captcha_image_pool, fixed_solution=captcha_test_solution,
+                                                     solution_for=self.captcha_signer.solution if self.captcha_signer else None)
+        self.captcha_controller = captcha.DifficultyController(base=captcha_difficulty, maximum=captcha_max_difficulty,
+                                                              busy_captchas=captcha_busy_captchas, busy_writes=captcha_busy_writes)
+        # captcha id -> png of its wave 2 image, so fetching it again doesn't re-render
+        self.captcha_images = LRUCache(maxsize=4096, ttl=captcha.CAPTCHA_TTL)
+        self.boards = None
+        # cookie -> Session or None. Short ttl bounds how long another worker process
+        # can keep honouring a cookie that was replaced by a fresh login.
+        self.sessions = LRUCache(maxsize=10000, ttl=60)
+        # rendered listings, filled by main.py and invalidated by new_post/new_comment here
+        self.pages = PageCache(shared_generation=page_generation)
+        if migrate:
+            self.setup()
+        else:
+            with self.handle() as (conn, cursor):
+                version = migrations.schema_version(cursor)
+            if version != len(migrations.MIGRATIONS):
+                raise RuntimeError(f"db: schema is at version {version}, expected {len(migrations.MIGRATIONS)}. Run the migrations first.")
+        self.reload_boards()
+
+    def setup(self):
+        with self.handle() as (conn, cursor):
+            # journal_mode is persistent in the file, so setting it once here is enough.
+            # WAL lets readers keep going while a post/comment is being written.
+            cursor.execute("PRAGMA journal_mode = WAL").fetchone()
+            before, after = migrations.migrate(conn)
+            if before != after:
+                print(f"db: schema upgraded from version {before} to {after}")
 
         if self.is_first_setup():
             print("Is first setup? Yes.")
             self.first_setup()
 
     def is_first_setup(self):
-        conn, cursor = self.handle()
-        cursor.execute("SELECT COUNT(*) FROM boards;")
-        yes = cursor.fetchone()[0] == 0
-        conn.close()
-        return yes
+        with self.handle() as (conn, cursor):
+            cursor.execute("SELECT COUNT(*) FROM boards;")
+            yes = cursor.fetchone()[0] == 0
+            return yes
 
     def first_setup(self):
-        conn, cursor = self.handle()
+        with self.handle() as (conn, cursor):
         
-        # Roles
-        cursor.execute('INSERT INTO roles (name) VALUES ("member")')
-        cursor.execute('INSERT INTO roles (name) VALUES ("moderator")')
-        cursor.execute('INSERT INTO roles (name) VALUES ("administator")')
-
-        # Boards
-        cursor.execute('INSERT INTO boards (name, description) VALUES ("random", "the default board, discussion about anything")')
-        cursor.execute('INSERT INTO boards (name, description) VALUES ("qna", "board for questions and answers only")')
-
-        # Finish
-        conn.commit()
-        conn.close()
+            # Roles
+            cursor.execute('INSERT INTO roles (name) VALUES ("member")')
+            cursor.execute('INSERT INTO roles (name) VALUES ("moderator")')
+            cursor.execute('INSERT INTO roles (name) VALUES ("administator")')
+
+            # Boards
+            cursor.execute('INSERT INTO boards (name, description) VALUES ("random", "the default board, discussion about anything")')
+            cursor.execute('INSERT INTO boards (name, description) VALUES ("qna", "board for questions and answers only")')
+
+            # Finish
+            conn.commit()
     
+    @contextmanager
     def handle(self):
         """
-        Get a handle to the database.
-        Returns: Connection Object, Cursor Object
+        Borrow a pooled handle to the database.
+        Usage: with database.handle() as (conn, cursor): ...
+        Anything not committed when the block ends is rolled back.
+        Yields: Connection Object, Cursor Object
         """
-        conn = sqlite3.connect(self.FILE)
-        cursor = conn.cursor()
-        cursor.execute('PRAGMA foreign_keys = ON;')
-        return conn, cursor
-
-    def board_id_from_name(self, name):
-        conn, cursor = self.handle()
-        cursor.execute("SELECT board_id FROM boards WHERE name = ? LIMIT 1", (name,))
-        id = cursor.fetchone()[0]
-        return id
-
-    def new_post(self, board, title, description, image_url = None, owner = None):
-        conn, cursor = self.handle()
-
-        board_id = self.board_id_from_name(board)
-        created_at, updated_at = helpers.timestamp(), helpers.timestamp()
+        conn = self.pool.acquire()
+        try:
+            yield conn, conn.cursor(metrics.TimedCursor) if metrics.enabled else conn.cursor()
+        finally:
+            self.pool.release(conn)
 
-        cursor.execute("""INSERT INTO posts (board_id, owner_id, title, description, image_url, created_at, updated_at) 
-                                        VALUES (?, ?, ?, ?, ?, ?, ?)""", 
-                                        (board_id, owner, title, description, image_url, created_at, updated_at))
+    def close(self):
+        self.writer.stop()
+        self.pool.close()
 
-        conn.commit()
-        conn.close()
+    #### BOARDS ####
 
-    def list_boards(self):
-        conn, cursor = self.handle()
-        cursor.execute("SELECT name FROM boards ORDER BY board_id ASC")
-        boards = [board[0] for board in cursor.fetchall()]
-        conn.close()
-        return boards # board id 0 first
-
-    def all_newest_posts(self, page = 0, top = 25):
-        conn, cursor = self.handle()
-        sql = """
-            SELECT
-                p.post_id,
-                p.title,
-                p.description,
-                p.image_url,
-                p.created_at,
-                p.updated_at,
-                b.name AS board_name,
-                u.username AS owner_username
-            FROM
-                posts p
-            JOIN
-                boards b ON p.board_id = b.board_id
-            LEFT JOIN
-                users u ON p.owner_id = u.user_id
-            ORDER BY
-                p.updated_at DESC
-            LIMIT ? OFFSET ?
+    def reload_boards(self):
+        """
+        (Re)load the board registry from the database.
+        Call this after changing the boards table by hand.
         """
+        with self.handle() as (conn, cursor):
+            cursor.execute("SELECT board_id, name, description FROM boards ORDER BY board_id ASC")
+            self.boards = BoardRegistry(cursor.fetchall())
+        return self.boards
+
+    def new_board(self, name, description):
+        self.writer.submit(lambda cursor: cursor.execute("INSERT INTO boards (name, description) VALUES (?, ?)", (name, description)))
+        self.reload_boards()
+        self.pages.clear() # every page lists the boards
+
+    def edit_board(self, name, new_name = None, description = None):
+        def write(cursor):
+            if new_name is not None:
+                cursor.execute("UPDATE boards SET name = ? WHERE name = ?", (new_name, name))
+            if description is not None:
+                cursor.execute("UPDATE boards SET description = ? WHERE name = ?", (description, new_name or name))
+        self.writer.submit(write)
+        self.reload_boards()
+        self.pages.clear()
 
-        posts_list = []
+    def board_id_from_name(self, name):
+        return self.boards.ids.get(name)
 
-        try:
-            cursor.execute(sql, (top, page*top))
+    def list_boards(self):
+        return self.boards.names # board id 0 first
 
-            rows = cursor.fetchall()
+    def board_description(self, board):
+        return self.boards.descriptions.get(board)
 
-            for row in rows:
-                post_dict = {
-                    'post_id': row[0], # p.post_id
-                    'title': row[1],   # p.title
-                    'description': row[2], # p.description
-                    'image_url': row[3], # p.image_url
-                    'created_at': helpers.time_ago(row[4]), # p.created_at
-                    'updated_at': row[5], # p.updated_at
-                    'board': row[6],   # b.name (board_name alias)
-                    'owner': row[7] if row[7] is not None else 'Anonymous'
-                }
-                posts_list.append(post_dict)
+    def board_updated_at(self, board = None):
+        """
+        When anything on a board (None for the front page) last changed, for conditional GETs.
+        Returns: newest updated_at of its posts, 0 if it has none, None if the board doesn't exist
+        """
+        with self.handle() as (conn, cursor):
+            if board is None:
+                cursor.execute("SELECT COALESCE(MAX(updated_at), 0) FROM posts")
+            else:
+                board_id = self.board_id_from_name(board)
+                if board_id is None:
+                    return None
+                cursor.execute("SELECT COALESCE(MAX(updated_at), 0) FROM posts WHERE board_id = ?", (board_id,))
+            return cursor.fetchone()[0]
 
-        except Exception as e:
-            posts_list = [] 
-        finally:
-            conn.close()
+    def board_activity(self, board):
+        """
+        Returns: (post count, comment count) of a board, None if it doesn't exist
+        """
+        board_id = self.board_id_from_name(board)
+        if board_id is None:
+            return None
+        with self.handle() as (conn, cursor):
+            cursor.execute("SELECT post_count, comment_count FROM boards WHERE board_id = ?", (board_id,))
+            return cursor.fetchone()
 
-        return posts_list
+    #### ENDOFBOARDS ####
 
-    def newest_posts(self, board, page = 0, top = 25):
-        conn, cursor = self.handle()
+    def new_post(self, board, title, description, image_url = None, owner = None):
+        """
+        Returns: id of the new post
+        """
+        board_id = self.board_id_from_name(board)
+        def write(cursor):
+            created_at, updated_at = helpers.timestamp(), helpers.timestamp()
+
+            cursor.execute("""INSERT INTO posts (board_id, owner_id, title, description, image_url, created_at, updated_at) 
+                                            VALUES (?, ?, ?, ?, ?, ?, ?)""", 
+                                            (board_id, owner, title, description, image_url, created_at, updated_at))
+            return cursor.lastrowid
+        post_id = self.writer.submit(write)
+        self.captcha_controller.write()
+        self.pages.invalidate(board)
+        return post_id
+
+    def all_newest_posts(self, before = None, after = None, top = 25):
+        """
+        Newest posts across all boards, see posts_page.
+        """
+        return self.posts_page(None, before=before, after=after, top=top)
 
+    def newest_posts(self, board, before = None, after = None, top = 25):
+        """
+        Newest posts in one board, see posts_page.
+        """
         board_id = self.board_id_from_name(board)
         if board_id is None:
             print(f"Info: Board '{board}' not found.")
-            conn.close()
-            return []
-        
-        sql = """
+            return [], None, None
+        return self.posts_page(board_id, before=before, after=after, top=top)
+
+    def posts_page(self, board_id, before = None, after = None, top = 25):
+        """
+        One page of posts ordered by (updated_at, post_id), newest first.
+        Uses keyset pagination so every page costs the same no matter how deep it is:
+        before: (updated_at, post_id) cursor, return the posts just older than it
+        after: (updated_at, post_id) cursor, return the posts just newer than it
+        board_id: only posts from this board, or None for all boards
+        Returns: posts list, cursor tuple for the older page or None, cursor tuple for the newer page or None
+        """
+        conditions, params = [], []
+        if board_id is not None:
+            conditions.append("p.board_id = ?")
+            params.append(board_id)
+        if before is not None:
+            conditions.append("(p.updated_at, p.post_id) < (?, ?)")
+            params.extend(before)
+        elif after is not None:
+            conditions.append("(p.updated_at, p.post_id) > (?, ?)")
+            params.extend(after)
+        # walking towards newer posts means reading the index the other way round
+        order = "ASC" if after is not None and before is None else "DESC"
+        where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+
+        sql = f"""
             SELECT
                 p.post_id,
                 p.title,
@@ -214,146 +307,207 @@ class Database():
                 p.created_at,
                 p.updated_at,
                 b.name AS board_name,
-                u.username AS owner_username
+                u.username AS owner_username,
+                p.comment_count,
+                p.last_comment_at,
+                lu.username AS last_commenter
             FROM
                 posts p
             JOIN
                 boards b ON p.board_id = b.board_id
             LEFT JOIN
                 users u ON p.owner_id = u.user_id
-            WHERE
-                p.board_id = ?
+            LEFT JOIN
+                users lu ON p.last_commenter_id = lu.user_id
+            {where}
             ORDER BY
-                p.updated_at DESC
-            LIMIT ? OFFSET ?
+                p.updated_at {order}, p.post_id {order}
+            LIMIT ?
         """
+        # one extra row tells us if there is another page without a COUNT(*)
+        params.append(top + 1)
 
         posts_list = []
+        more = False
+        with self.handle() as (conn, cursor):
+            try:
+                cursor.row_factory = Post.from_row
+                cursor.execute(sql, params)
+                posts_list = cursor.fetchall()
+                more = len(posts_list) > top
+                posts_list = posts_list[:top]
+                if order == "ASC":
+                    posts_list.reverse()
+            except Exception as e:
+                posts_list = []
+
+        if order == "ASC" and not more:
+            # walked back to the newest posts, show a full first page instead of a partial one
+            return self.posts_page(board_id, top=top)
+
+        older = newer = None
+        if posts_list:
+            first, last = posts_list[0], posts_list[-1]
+            if more or order == "ASC":
+                older = (last.updated_at, last.post_id)
+            if before is not None or order == "ASC":
+                newer = (first.updated_at, first.post_id)
+        return posts_list, older, newer
 
-        try:
-            cursor.execute(sql, (board_id, top, page*top))
-
-            rows = cursor.fetchall()
-
-            for row in rows:
-                post_dict = {
-                    'post_id': row[0], # p.post_id
-                    'title': row[1],   # p.title
-                    'description': row[2], # p.description
-                    'image_url': row[3], # p.image_url
-                    'created_at': helpers.time_ago(row[4]), # p.created_at
-                    'updated_at': row[5], # p.updated_at
-                    'board': row[6],   # b.name (board_name alias)
-                    'owner': row[7] if row[7] is not None else 'Anonymous'
-                }
-                posts_list.append(post_dict)
-
-        except Exception as e:
-            posts_list = [] 
-        finally:
-            conn.close()
-
-        return posts_list
-    
     #### CAPTCHA ####
+    # records live in self.captchas, see captcha.py for the backends.
+    # signed captchas (self.captcha_signer) have no records, their tokens carry everything
 
     def captcha_create(self):
-        conn, cursor = self.handle()
-        wave = 1
-        captcha_token = helpers.generate_uuid()
-        wave_two_solution = helpers.generate_short_code()
+        """
+        Returns: token of the new captcha, its wave 1 difficulty
+        """
+        captcha_id, wave_two_solution, image = self.captcha_pool.take()
         created_at = helpers.timestamp()
+        self.captcha_controller.captcha_issued()
+        difficulty = self.captcha_controller.difficulty()
 
-        cursor.execute("INSERT INTO captchas (captcha_token, created_at, wave, wave_two_solution) VALUES (?, ?, ?, ?)",
-                        (captcha_token, created_at, wave, wave_two_solution))
-        conn.commit()
-        conn.close()
+        if self.captcha_signer is not None:
+            captcha_token = self.captcha_signer.issue(captcha_id, created_at, difficulty)
+        else:
+            captcha_token = captcha_id
+            self.captchas.create(captcha_token, created_at, wave_two_solution, difficulty)
+            # could be put anywhere but here is a good place i think
+            self.captchas.expire(created_at)
+        self.captcha_images.set(captcha_id, image)
+        metrics.captcha_total.inc("issued")
+        metrics.pow_difficulty.observe(difficulty)
 
-        # could be put anywhere but here is a good place i think
-        self.captcha_purge()
+        return captcha_token, difficulty
 
-        return captcha_token
-    
     def captcha_delete(self, captcha_token):
-        conn, cursor = self.handle()
-        cursor.execute("DELETE FROM captchas WHERE captcha_token = ?", (captcha_token,))
-        conn.commit()
-        conn.close()
-
-    def captcha_purge(self):
-        conn, cursor = self.handle()
-        created = helpers.timestamp()
-        # remove old captchas, solved 10min+ ago
-        time_threshold = helpers.timestamp() - 600
-        cursor.execute("DELETE FROM captchas WHERE created_at < ?", (time_threshold,))
-        conn.commit()
-        conn.close()
-
-    def captcha_check_wave_1(self, captcha_token, nonce, difficulty=15):
-        conn, cursor = self.handle()
+        self.captchas.delete(captcha_token)
+        self.captcha_images.delete(captcha_token)
+
+    def captcha_get(self, captcha_token):
+        """
+        Returns: (created_at, wave, wave_two_solution, difficulty), or None if unknown or expired
+        """
+        record = self.captchas.get(captcha_token)
+        if record is None or record[0] < helpers.timestamp() - captcha.CAPTCHA_TTL:
+            return None
+        return record
+
+    def captcha_check_wave_1(self, captcha_token, nonce):
+        """
+        Returns: the token to send along with the wave 2 answer (the same one, or a
+                 new wave 2 token for signed captchas), None if the proof of work is wrong
+        """
         # check if the challenge is even valid, if not, spoofed solution
-        cursor.execute("SELECT COUNT(*) FROM captchas WHERE captcha_token = ?", (captcha_token,))
-        count = cursor.fetchone()[0]
-        if count == 0: 
-            conn.close()
-            return False # captcha was never even created
-        # captchas already on wave 2 are also invalid
-        cursor.execute("SELECT wave FROM captchas WHERE captcha_token = ?", (captcha_token,))
-        wave = cursor.fetchone()[0]
+        if not captcha_token or not nonce or len(nonce) > 64:
+            record = None
+        elif self.captcha_signer is not None:
+            claims = self.captcha_signer.verify(captcha_token, 1, helpers.timestamp())
+            # signed captchas go straight to wave 2, there is nothing to remember
+            record = (claims[1], 1, None, claims[2]) if claims else None
+        else:
+            record = self.captcha_get(captcha_token)
+        if record is None:
+            metrics.captcha_total.inc("wave1_failed")
+            return None # captcha was never even created
+        created_at, wave, wave_two_solution, difficulty = record
+        # the difficulty it was issued with, whatever it is now
+        started = time.perf_counter()
+        is_valid = helpers.check_pow(captcha_token, nonce, difficulty)[0]
+        metrics.pow_verify_seconds.observe(time.perf_counter() - started)
+        if self.captcha_signer is not None:
+            metrics.captcha_total.inc("wave1_passed" if is_valid else "wave1_failed")
+            if not is_valid:
+                return None
+            return self.captcha_signer.issue(claims[0], created_at, difficulty, wave=2)
+        # captchas already on wave 2 may fetch their image again with the same proof, but nothing changes
         if wave == 2:
-            conn.close()
-            return False
-        # compute hash challenge
-        challenge = "popcap-" + captcha_token + "-popcap-" + nonce + "-popcap"
-        completed = hashlib.sha256(challenge.encode('utf-8')).hexdigest()
-        # validity check
-        is_valid = completed.count('0') >= difficulty
-        # if valid, mark captcha as wave 2, if not, remove captcha from database
+            return captcha_token if is_valid else None
+        # if valid, mark captcha as wave 2, if not, remove captcha
         if is_valid:
-            cursor.execute("UPDATE captchas SET wave = 2 WHERE captcha_token = ?", (captcha_token,))
-        else:
-            self.captcha_delete(captcha_token)
-        conn.commit()
-        conn.close()
-        return is_valid
+            self.captchas.set_wave(captcha_token, 2)
+            metrics.captcha_total.inc("wave1_passed")
+            return captcha_token
+        self.captcha_delete(captcha_token)
+        metrics.captcha_total.inc("wave1_failed")
+        return None
 
     def captcha_check_wave_2(self, captcha_token, wave_two_input):
-        conn, cursor = self.handle()
-        # get the w2 solution from db
-        cursor.execute("SELECT wave, wave_two_solution FROM captchas WHERE captcha_token = ?", (captcha_token,))
-        result = cursor.fetchone()
-        if result is None: return False
-        wave, wave_two_solution = result
-        # do a check if wave 1 was actually solved
-        if wave == 1:
-            self.captcha_delete(captcha_token)
-            return False # wave 1 was not solved, so captcha is invalid
-        # check if solution is correct
-        is_valid = wave_two_solution == wave_two_input
-        # wether valid or not, captcha is no longer needed
-        self.captcha_delete(captcha_token)
-        # return state
+        if self.captcha_signer is not None:
+            now = helpers.timestamp()
+            claims = self.captcha_signer.verify(captcha_token, 2, now)
+            # spent whether the answer is right or not, like a deleted record
+            is_valid = (claims is not None and self.captcha_signer.spent.spend(claims[0], claims[1], now)
+                        and hmac.compare_digest(self.captcha_signer.solution(claims[0]).encode(), (wave_two_input or "").encode()))
+            if claims is not None:
+                self.captcha_images.delete(claims[0])
+            metrics.captcha_total.inc("wave2_passed" if is_valid else "wave2_failed")
+            return is_valid
+        # get the w2 solution and, wether valid or not, remove the captcha in the same step
+        record = self.captchas.take(captcha_token) if captcha_token else None
+        self.captcha_images.delete(captcha_token)
+        if record is None or record[0] < helpers.timestamp() - captcha.CAPTCHA_TTL:
+            metrics.captcha_total.inc("wave2_failed")
+            return False
+        created_at, wave, wave_two_solution, difficulty = record
+        # do a check if wave 1 was actually solved, and if so, if the solution is correct
+        is_valid = wave != 1 and wave_two_solution == wave_two_input
+        metrics.captcha_total.inc("wave2_passed" if is_valid else "wave2_failed")
         return is_valid
 
     def captcha_get_wave_two_solution(self, captcha_token):
-        conn, cursor = self.handle()
-        cursor.execute("SELECT wave_two_solution FROM captchas WHERE captcha_token = ?", (captcha_token,))
-        wave2_sol = cursor.fetchone()[0]
-        conn.close()
-        return wave2_sol
+        """
+        Returns: (captcha id, wave 2 solution), or (None, None) if the captcha doesn't exist
+        """
+        if self.captcha_signer is not None:
+            claims = self.captcha_signer.verify(captcha_token, 1, helpers.timestamp())
+            return (claims[0], self.captcha_signer.solution(claims[0])) if claims else (None, None)
+        record = self.captcha_get(captcha_token)
+        return (captcha_token, record[2]) if record else (None, None)
+
+    def captcha_image(self, captcha_token):
+        """
+        PNG bytes of the wave 2 image, rendered at most once per captcha.
+        captcha_token: the wave 1 token
+        Returns: bytes, or None if the captcha doesn't exist
+        """
+        captcha_id = captcha_token
+        if self.captcha_signer is not None:
+            claims = self.captcha_signer.verify(captcha_token, 1, helpers.timestamp())
+            if claims is None:
+                return None
+            captcha_id = claims[0]
+        image = self.captcha_images.get(captcha_id)
+        if image is not None:
+            return image
+        captcha_id, wave_two_solution = self.captcha_get_wave_two_solution(captcha_token)
+        if wave_two_solution is None:
+            return None
+        # not issued by this process (sqlite store or signed) or evicted from the cache
+        image = helpers.create_captcha_image(wave_two_solution)
+        self.captcha_images.set(captcha_id, image)
+        return image
 
     #### ENDOFCAPTCHA ####
     
-    def board_description(self, board):
-        conn, cursor = self.handle()
-        cursor.execute("SELECT description FROM boards WHERE name = ? LIMIT 1", (board,))
-        desc = cursor.fetchone()[0]
-        conn.close()
-        return desc
-    
+    def post_updated_at(self, post_id):
+        """
+        When a post or its comments last changed, for conditional GETs.
+        Returns: updated_at, or None if the post doesn't exist
+        """
+        with self.handle() as (conn, cursor):
+            cursor.execute("SELECT updated_at FROM posts WHERE post_id = ?", (post_id,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
     def get_post_by_id(self, post_id):
-        conn, cursor = self.handle()
-                
+        """
+        Returns: Post, or None if it doesn't exist
+        """
+        with self.handle() as (conn, cursor):
+            return self.read_post(cursor, post_id)
+
+    def read_post(self, cursor, post_id):
         sql = """
             SELECT
                 p.post_id,
@@ -363,36 +517,76 @@ class Database():
                 p.created_at,
                 p.updated_at,
                 b.name AS board_name,
-                u.username AS owner_username
+                u.username AS owner_username,
+                p.comment_count,
+                p.last_comment_at,
+                lu.username AS last_commenter
             FROM
                 posts p
             JOIN
                 boards b ON p.board_id = b.board_id
             LEFT JOIN
                 users u ON p.owner_id = u.user_id
+            LEFT JOIN
+                users lu ON p.last_commenter_id = lu.user_id
             WHERE
                 p.post_id = ?
             LIMIT 1
         """
-
+        cursor.row_factory = Post.from_row
         cursor.execute(sql, (post_id,))
-        row = cursor.fetchone()
-        post_dict = {
-            'post_id': row[0], # p.post_id
-            'title': row[1],   # p.title
-            'description': row[2], # p.description
-            'image_url': row[3], # p.image_url
-            'created_at': helpers.time_ago(row[4]), # p.created_at
-            'updated_at': row[5], # p.updated_at
-            'board': row[6],   # b.name (board_name alias)
-            'owner': row[7] if row[7] is not None else 'Anonymous'
-        }
-        conn.close()
-        return post_dict
-    
-    def get_comments_by_post_id(self, post_id):
-        conn, cursor = self.handle()
+        return cursor.fetchone()
 
+    def get_comment_window(self, post_id, after = None, thread = None, roots = 20, depth = 6, limit = 500):
+        """
+        Load one window of a post's comment tree, never reading comments outside it.
+        after: path of the last comment of the previous window, the window goes on right after it
+        thread: comment_id to load the subtree of ("continue this thread") instead of top level comments
+        roots: top level comments per window, not counting the rest of one the previous window cut off
+        depth: levels loaded below each top level comment
+        limit: hard cap on comments loaded, whatever the tree looks like
+        Returns: list of top level Comments with nested .replies, path to pass as after= for the next window or None
+        A comment whose reply_count is larger than len(replies) continues outside the window.
+        """
+        with self.handle() as (conn, cursor):
+            window, next_after, by_id = self.read_comment_window(cursor, post_id, after, thread, roots, depth, limit)
+        return window, next_after
+
+    def read_comment_window(self, cursor, post_id, after = None, thread = None, roots = 20, depth = 6, limit = 500):
+        """
+        get_comment_window() on a cursor you already have.
+        Returns: top level Comments, next after= or None, {comment_id: Comment} of everything loaded
+        """
+        cursor.row_factory = None
+        more_roots = False
+        if thread is not None:
+            cursor.execute("SELECT path, depth FROM comments WHERE comment_id = ? AND post_id = ?", (thread, post_id))
+            row = cursor.fetchone()
+            if row is None or row[0] is None:
+                return [], None, {}
+            first_path, end_path, top_depth = row[0], row[0] + "0", row[1]
+        else:
+            # roots after the one the cursor points into, that one is finished first.
+            # A root's path is its own id in hex, so this stays on the roots index
+            after_root = int(after.split("/")[0], 16) if after else 0
+            cursor.execute("""SELECT path FROM comments
+                              WHERE post_id = ? AND parent_comment_id IS NULL AND comment_id > ?
+                              ORDER BY comment_id LIMIT ?""", (post_id, after_root, roots + 1))
+            root_rows = cursor.fetchall()
+            if len(root_rows) > roots:
+                root_rows = root_rows[:roots]
+                more_roots = True
+            if root_rows:
+                first_path, end_path = root_rows[0][0], root_rows[-1][0] + "0"
+            elif after:
+                first_path, end_path = None, after.split("/")[0] + "0"
+            else:
+                return [], None, {}
+            top_depth = 0
+
+        # the subtrees of first..last are exactly the paths in [first, last + '0'),
+        # because '/' sorts right before the hex digits. Continuing a window starts
+        # right after the last comment it had instead.
         sql = """
             SELECT
                 c.comment_id,
@@ -402,129 +596,278 @@ class Database():
                 c.content,
                 c.created_at,
                 c.updated_at,
-                u.username AS owner_username
+                u.username AS owner_username,
+                c.depth,
+                c.reply_count,
+                c.path
             FROM
                 comments c
             LEFT JOIN
                 users u ON c.owner_id = u.user_id
             WHERE
-                c.post_id = ?
+                c.post_id = ? AND {} AND c.path < ? AND c.depth <= ?
             ORDER BY
-                c.created_at DESC
-        """
-
-        comments_list = []
-        try:
-            cursor.execute(sql, (post_id,))
-            rows = cursor.fetchall()
-
-            for row in rows:
-                comment_dict = {
-                    'comment_id': row[0],
-                    'post_id': row[1],
-                    'owner_id': row[2],
-                    'parent_comment_id': row[3],
-                    'content': row[4],
-                    'created_at': helpers.time_ago(row[5]), # Format timestamp
-                    'updated_at': row[6],
-                    'owner': row[7] if row[7] is not None else 'Anonymous',
-                    'replies': [] # Initialize replies list for tree building
-                }
-                comments_list.append(comment_dict)
-
-        except Exception as e:
-            print(f"Error fetching comments: {e}")
-            comments_list = []
-        finally:
-            conn.close()
+                c.path
+            LIMIT ?
+        """.format("c.path > ?" if after else "c.path >= ?")
+        cursor.row_factory = Comment.from_row
+        cursor.execute(sql, (post_id, after or first_path, end_path, top_depth + depth, limit + 1))
+        comments = cursor.fetchall()
+
+        # one row more than the cap says whether the window got cut off, the
+        # next one goes on after the last comment shown, inside its subtree or not
+        next_after = None
+        if len(comments) > limit:
+            comments = comments[:limit]
+            next_after = comments[-1].path
+        elif more_roots:
+            next_after = comments[-1].path
+
+        # rows come in depth first order (path is made of ids, so replies in order of creation),
+        # every parent is seen before its replies. Replies whose parent was in the
+        # previous window start at the top.
+        by_id = {}
+        window = []
+        for comment in comments:
+            by_id[comment.comment_id] = comment
+            parent = by_id.get(comment.parent_comment_id)
+            if parent is not None:
+                parent.replies.append(comment)
+            else:
+                window.append(comment)
+        return window, next_after, by_id
 
-        return comments_list
+    def load_post_page(self, post_id, reply_to = None, cookie = None, after = None, thread = None):
+        """
+        Everything the post page shows, read over one connection.
+        reply_to: comment_id the user is replying to, ignored if it isn't a comment of this post
+        cookie: the account cookie, for the username in the header
+        after, thread: which window of the comments, see get_comment_window
+        Returns: PostPage(post, comments, next_after, replying_to, session), or None if the post doesn't exist
+        """
+        with self.handle() as (conn, cursor):
+            post = self.read_post(cursor, post_id)
+            if post is None:
+                return None
+            comments, next_after, by_id = self.read_comment_window(cursor, post_id, after=after, thread=thread)
+
+            # usually one of the comments on screen, only ask sqlite when it isn't
+            replying_to = by_id.get(reply_to) if reply_to is not None else None
+            if reply_to is not None and replying_to is None:
+                cursor.row_factory = Comment.from_row
+                cursor.execute("""
+                    SELECT
+                        c.comment_id, c.post_id, c.owner_id, c.parent_comment_id, c.content, c.created_at, c.updated_at,
+                        u.username AS owner_username, c.depth, c.reply_count
+                    FROM
+                        comments c
+                    LEFT JOIN
+                        users u ON c.owner_id = u.user_id
+                    WHERE
+                        c.comment_id = ? AND c.post_id = ?
+                """, (reply_to, post_id))
+                replying_to = cursor.fetchone()
+
+            session = self.resolve_session(cookie, cursor)
+        return PostPage(post, comments, next_after, replying_to, session)
 
     def new_comment(self, post_id, content, owner_id=None, parent_comment_id=None):
-        conn, cursor = self.handle()
-        created_at, updated_at = helpers.timestamp(), helpers.timestamp()
+        """
+        Returns: id of the new comment, None if it couldn't be created
+        """
+        def write(cursor):
+            nonlocal parent_comment_id
+            created_at, updated_at = helpers.timestamp(), helpers.timestamp()
+
+            parent_path, depth = None, 0
+            if parent_comment_id is not None:
+                cursor.execute("SELECT path, depth FROM comments WHERE comment_id = ? AND post_id = ?", (parent_comment_id, post_id))
+                parent = cursor.fetchone()
+                if parent is None or parent[0] is None:
+                    # replying to a comment that isn't part of this post, make it a top level comment
+                    parent_comment_id = None
+                else:
+                    parent_path, depth = parent[0], parent[1] + 1
+
+            cursor.execute("""INSERT INTO comments (post_id, owner_id, parent_comment_id, content, created_at, updated_at, depth)
+                              VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                           (post_id, owner_id, parent_comment_id, content, created_at, updated_at, depth))
+            comment_id = cursor.lastrowid
+            path = helpers.comment_path(parent_path, comment_id)
+            cursor.execute("UPDATE comments SET path=? WHERE comment_id=?", (path, comment_id))
+            if parent_comment_id is not None:
+                cursor.execute("UPDATE comments SET reply_count = reply_count + 1 WHERE comment_id=?", (parent_comment_id,))
+            cursor.execute("UPDATE posts SET updated_at=? WHERE post_id=?", (updated_at, post_id))
+            cursor.execute("SELECT board_id FROM posts WHERE post_id=?", (post_id,))
+            return comment_id, cursor.fetchone()[0]
 
         try:
-            cursor.execute("""INSERT INTO comments (post_id, owner_id, parent_comment_id, content, created_at, updated_at)
-                              VALUES (?, ?, ?, ?, ?, ?)""",
-                           (post_id, owner_id, parent_comment_id, content, created_at, updated_at))
-            cursor.execute("UPDATE posts SET updated_at=? WHERE post_id=?", (updated_at, post_id))
-            conn.commit()
-            print(f"New comment created for post {post_id}.")
+            comment_id, board_id = self.writer.submit(write)
         except Exception as e:
             print(f"Error creating comment: {e}")
-            conn.rollback()
-        finally:
-            conn.close()
+            return None
+        print(f"New comment created for post {post_id}.")
+        self.captcha_controller.write()
+        # the comment bumped the post to the top of its board and the front page
+        self.pages.invalidate(self.boards.names_by_id.get(board_id))
+        return comment_id
 
-    # Helper function to build a threaded comment tree from a flat list
-    def build_comment_tree(self, comments_list):
-        comment_dict = {c['comment_id']: c for c in comments_list}
-        root_comments = []
+    #### SEARCH ####
 
-        for comment in comments_list:
-            if comment['parent_comment_id'] is None:
-                root_comments.append(comment)
-            else:
-                parent = comment_dict.get(comment['parent_comment_id'])
-                if parent is not None:
-                    parent['replies'].append(comment)
-                # Handle orphaned replies if parent_comment_id exists but parent doesn't exist in list
-                # For this implementation, we'll just ignore them or add them as root if needed,
-                # but typically you'd ensure data integrity or handle this case.
-                # Appending to root if parent not found:
-                # else:
-                #     root_comments.append(comment)
-
-        # Optional: Sort replies by creation date
-        for comment in comment_dict.values():
-            if 'replies' in comment:
-                comment['replies'].sort(key=lambda x: x['updated_at']) # Sorting by updated_at as created_at is already formatted
-
-        # Sort root comments by creation date
-        root_comments.sort(key=lambda x: x['updated_at'])
-
-        return root_comments
+    def search(self, query, board = None, page = 0, top = 25):
+        """
+        Ranked full text search over post titles/descriptions and comments.
+        query: what the user typed, every word has to match
+        board: only search in this board, None for everywhere
+        Returns: list of SearchResult (best match first), True if there is another page
+        """
+        match = helpers.fts_query(query)
+        if match is None:
+            return [], False
+        board_id = None
+        if board:
+            board_id = self.board_id_from_name(board)
+            if board_id is None:
+                return [], False
+        board_filter = "AND p.board_id = ?" if board_id is not None else ""
+        params = (match, board_id) if board_id is not None else (match,)
+        # both indexes are ranked separately (fts5 does ORDER BY rank LIMIT cheaply)
+        # and merged here, so a page only needs the top few hits of each
+        wanted = (page + 1) * top + 1
+
+        with self.handle() as (conn, cursor):
+            cursor.row_factory = SearchResult.from_row
+            cursor.execute(f"""
+                SELECT
+                    p.post_id,
+                    NULL,
+                    p.title,
+                    snippet(posts_fts, -1, char(2), char(3), '...', 24),
+                    p.created_at,
+                    b.name,
+                    u.username,
+                    posts_fts.rank
+                FROM posts_fts
+                JOIN posts p ON p.post_id = posts_fts.rowid
+                JOIN boards b ON p.board_id = b.board_id
+                LEFT JOIN users u ON p.owner_id = u.user_id
+                WHERE posts_fts MATCH ? {board_filter}
+                ORDER BY posts_fts.rank
+                LIMIT {wanted}
+            """, params)
+            rows = cursor.fetchall()
+            cursor.execute(f"""
+                SELECT
+                    c.post_id,
+                    c.comment_id,
+                    p.title,
+                    snippet(comments_fts, 0, char(2), char(3), '...', 24),
+                    c.created_at,
+                    b.name,
+                    u.username,
+                    comments_fts.rank
+                FROM comments_fts
+                JOIN comments c ON c.comment_id = comments_fts.rowid
+                JOIN posts p ON p.post_id = c.post_id
+                JOIN boards b ON p.board_id = b.board_id
+                LEFT JOIN users u ON c.owner_id = u.user_id
+                WHERE comments_fts MATCH ? {board_filter}
+                ORDER BY comments_fts.rank
+                LIMIT {wanted}
+            """, params)
+            rows += cursor.fetchall()
+
+        # bm25 ranks are negative, lower is better
+        rows.sort(key=lambda result: result.rank)
+        more = len(rows) > (page + 1) * top
+        results = rows[page * top:(page + 1) * top]
+        for result in results:
+            result.snippet = helpers.highlight_snippet(result.snippet)
+        return results, more
+
+    def rebuild_search_index(self):
+        """
+        Re-index every post and comment, e.g. after bulk changes made with the triggers off.
+        """
+        with self.handle() as (conn, cursor):
+            migrations.rebuild_search(cursor)
+            conn.commit()
+
+    #### ENDOFSEARCH ####
 
     # AUTH
+    def resolve_session(self, cookie, cursor = None):
+        """
+        Look up who a session cookie belongs to.
+        Results (including unknown cookies) are kept in a short lived LRU, so
+        most requests never reach sqlite. Requests without a cookie never do.
+        cursor: use this cursor instead of borrowing a connection
+        Returns: Session(user_id, username, role) or None
+        """
+        if not cookie:
+            return None
+        session = self.sessions.get(cookie, NO_SESSION)
+        if session is not NO_SESSION:
+            return session
+
+        if cursor is None:
+            with self.handle() as (conn, cursor):
+                return self.resolve_session(cookie, cursor)
+        cursor.row_factory = None
+        cursor.execute("""
+            SELECT u.user_id, u.username, r.name
+            FROM users u
+            LEFT JOIN roles r ON u.role_id = r.role_id
+            WHERE u.cookie = ?
+            LIMIT 1
+        """, (cookie,))
+        row = cursor.fetchone()
+        session = Session(*row) if row else None
+        self.sessions.set(cookie, session)
+        return session
+
     def get_id_from_cookie(self, cookie):
-        conn, cursor = self.handle()
-        cursor.execute("SELECT user_id FROM users WHERE cookie = ?", (cookie,))
-        user_id = cursor.fetchone()
-        conn.close()
-        return user_id[0] if user_id else None
+        session = self.resolve_session(cookie)
+        return session.user_id if session else None
     def get_name_from_cookie(self, cookie):
-        conn, cursor = self.handle()
-        cursor.execute("SELECT username FROM users WHERE cookie = ?", (cookie,))
-        user_name = cursor.fetchone()
-        conn.close()
-        return user_name[0] if user_name else None
+        session = self.resolve_session(cookie)
+        return session.username if session else None
 
     def account_exists(self, username):
-        conn, cursor = self.handle()
-        cursor.execute("SELECT COUNT(*) FROM users WHERE username = ?", (username,))
-        count = cursor.fetchone()[0]
-        conn.close()
-        return count != 0
+        with self.handle() as (conn, cursor):
+            cursor.execute("SELECT COUNT(*) FROM users WHERE username = ?", (username,))
+            count = cursor.fetchone()[0]
+            return count != 0
     
     def new_account(self, username, password):
-        conn, cursor = self.handle()
         cookie = helpers.generate_cookie_code()
-        cursor.execute("INSERT INTO users (username, password, cookie) VALUES (?, ?, ?)", (username, password, cookie))
-        conn.commit()
-        conn.close()
+        self.writer.submit(lambda cursor: cursor.execute("INSERT INTO users (username, password, cookie) VALUES (?, ?, ?)",
+                                                         (username, password, cookie)))
+        self.captcha_controller.write()
+        self.sessions.delete(cookie)
         return cookie
     
     def account_login(self, username, password):
-        conn, cursor = self.handle()
-        # check if password is valid
-        cursor.execute("SELECT password FROM users WHERE username = ?", (username,))
-        real_password = cursor.fetchone()[0]
+        with self.handle() as (conn, cursor):
+            # check if password is valid
+            cursor.execute("SELECT password, cookie FROM users WHERE username = ?", (username,))
+            row = cursor.fetchone()
+            if row is None:
+                return False
+            real_password, old_cookie = row
         if password != real_password:
             return False
 
         cookie = helpers.generate_cookie_code()
-        cursor.execute("UPDATE users SET cookie = ? WHERE username = ?", (cookie, username))
-        conn.commit()
-        conn.close()
-        return cookie
\ No newline at end of file
+        self.writer.submit(lambda cursor: cursor.execute("UPDATE users SET cookie = ? WHERE username = ?", (cookie, username)))
+        # the old cookie stops working, don't let the cache keep it alive
+        if old_cookie:
+            self.sessions.delete(old_cookie)
+        self.sessions.delete(cookie)
+        return cookie
+
+    def account_logout(self, cookie):
+        if not cookie:
+            return
+        self.writer.submit(lambda cursor: cursor.execute("UPDATE users SET cookie = NULL WHERE cookie = ?", (cookie,)))
+        self.sessions.delete(cookie)
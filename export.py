@@ -0,0 +1,233 @@
+"""
+Bulk export and import of a onepop database as NDJSON, one json object per line.
+
+    python export.py dump --db onepop.db --output forum.ndjson.gz
+    python export.py load forum.ndjson.gz --db new.db
+
+A dump is a header line followed by roles, boards, users, posts and comments
+in that order, each sorted by id so parents always come before their replies.
+Every line has a "type" and the table's columns. Users are exported without
+password hashes and cookies: imported accounts exist, but can't log in.
+Files ending in .gz are (de)compressed on the fly.
+
+Both directions stream, so memory use stays flat however big the forum is.
+The import goes through executemany in big transactions, with the secondary
+indexes and full text triggers dropped during the load and rebuilt in one
+pass at the end, which is much faster than maintaining them row by row.
+The same goes for the post and board activity counters.
+"""
+import argparse
+import contextlib
+import gzip
+import json
+import sys
+import time
+
+import config
+import helpers
+import migrations
+from database import Database
+
+# type, table, columns. Derived comment columns (path, depth, reply_count) are
+# exported too so an import doesn't have to recompute them, but are optional.
+TABLES = (
+    ("role", "roles", ("role_id", "name")),
+    ("board", "boards", ("board_id", "name", "description")),
+    ("user", "users", ("user_id", "username", "role_id")),
+    ("post", "posts", ("post_id", "board_id", "owner_id", "title", "description", "image_url", "created_at", "updated_at")),
+    ("comment", "comments", ("comment_id", "post_id", "owner_id", "parent_comment_id", "content", "created_at", "updated_at",
+                             "path", "depth", "reply_count")),
+)
+
+# the first setup creates default roles and boards, dumps overwrite them by id
+REPLACED = ("roles", "boards")
+
+def open_file(path, mode):
+    if path == "-":
+        # don't close stdin/stdout when the with-block ends
+        return contextlib.nullcontext(sys.stdout if "w" in mode else sys.stdin)
+    if path.endswith(".gz"):
+        # level 6 compresses nearly as well as 9 at a fraction of the cpu time
+        return gzip.open(path, mode + "t", encoding="utf-8", compresslevel=6)
+    return open(path, mode, encoding="utf-8")
+
+def dump(database, out, batch=10000):
+    """
+    Write every exported table to the file object out.
+    Returns: rows written per type
+    """
+    counts = {}
+    encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+    with database.handle() as (conn, cursor):
+        # one read transaction, so the dump is a consistent snapshot even while the forum is live
+        cursor.execute("BEGIN")
+        out.write(json.dumps({"type": "onepop", "schema_version": migrations.schema_version(cursor),
+                              "exported_at": helpers.timestamp()}) + "\n")
+        for kind, table, columns in TABLES:
+            counts[kind] = 0
+            key = columns[0]
+            cursor.execute(f"SELECT {', '.join(columns)} FROM {table} ORDER BY {key}")
+            while True:
+                rows = cursor.fetchmany(batch)
+                if not rows:
+                    break
+                out.write("".join(encode({"type": kind, **dict(zip(columns, row))}) + "\n" for row in rows))
+                counts[kind] += len(rows)
+        conn.rollback()
+    return counts
+
+def drop_derived(cursor):
+    """
+    Drop the secondary indexes and triggers of the loaded tables.
+    Returns: their CREATE statements, for restore_derived()
+    """
+    tables = tuple(table for kind, table, columns in TABLES)
+    cursor.execute(f"""SELECT type, name, sql FROM sqlite_master
+                       WHERE type IN ('index', 'trigger') AND sql IS NOT NULL
+                       AND tbl_name IN ({', '.join('?' * len(tables))})""", tables)
+    derived = cursor.fetchall()
+    for kind, name, sql in derived:
+        cursor.execute(f'DROP {kind.upper()} "{name}"')
+    return derived
+
+def restore_derived(cursor, derived, rebuild_paths):
+    # indexes first, sorting once per index is far cheaper than inserting into it row by row
+    for kind, name, sql in sorted(derived, key=lambda item: item[0] != "index"):
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,))
+        if cursor.fetchone():
+            continue # a failed load that never committed got it back from the rollback
+        print(f"load: rebuilding {kind} {name}")
+        cursor.execute(sql)
+    if rebuild_paths:
+        print("load: computing comment paths")
+        migrations.backfill_comment_paths(cursor)
+    print("load: rebuilding the search index")
+    migrations.rebuild_search(cursor)
+    # the activity triggers were off during the load, so the counters are all still zero
+    print("load: counting comments and posts")
+    migrations.backfill_activity(cursor)
+
+def load(database, source, batch=10000, commit_every=500000):
+    """
+    Insert a dump from the file object source. posts, comments and users have to be empty.
+    Returns: rows inserted per type
+    """
+    statements = {}
+    for kind, table, columns in TABLES:
+        names = list(columns)
+        values = ["?"] * len(columns)
+        if table == "users":
+            # no password hash in dumps, and '' never matches one
+            names.append("password")
+            values.append("''")
+        verb = "INSERT OR REPLACE" if table in REPLACED else "INSERT"
+        statements[kind] = (f"{verb} INTO {table} ({', '.join(names)}) VALUES ({', '.join(values)})", columns)
+
+    counts = {kind: 0 for kind, table, columns in TABLES}
+    rebuild_paths = False
+    with database.handle() as (conn, cursor):
+        for table in ("users", "posts", "comments"):
+            cursor.execute(f"SELECT EXISTS (SELECT 1 FROM {table})")
+            if cursor.fetchone()[0]:
+                raise RuntimeError(f"load: {table} isn't empty, import into a fresh database")
+
+        header = json.loads(source.readline() or "{}")
+        if header.get("type") != "onepop":
+            raise RuntimeError("load: not a onepop dump (the first line should be the onepop header)")
+
+        # rows come in dependency order, so checking every reference along the way is wasted time.
+        # nothing else should use the file while it loads, durability only matters at the end.
+        cursor.execute("PRAGMA foreign_keys = OFF")
+        cursor.execute("PRAGMA synchronous = OFF")
+        cursor.execute("BEGIN")
+        derived = drop_derived(cursor)
+        try:
+            pending, rows, since_commit = None, [], 0
+
+            def flush():
+                nonlocal since_commit
+                if rows:
+                    cursor.executemany(statements[pending][0], rows)
+                    counts[pending] += len(rows)
+                    since_commit += len(rows)
+                    rows.clear()
+                if since_commit >= commit_every:
+                    conn.commit()
+                    cursor.execute("BEGIN")
+                    since_commit = 0
+                    print(f"load: {sum(counts.values())} rows")
+
+            for line in source:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                kind = record.get("type")
+                if kind not in statements:
+                    raise RuntimeError(f"load: unknown record type {kind!r}")
+                if kind != pending or len(rows) >= batch:
+                    flush()
+                    pending = kind
+                columns = statements[kind][1]
+                if kind == "comment" and record.get("path") is None:
+                    rebuild_paths = True
+                    record["depth"] = record.get("depth") or 0
+                    record["reply_count"] = record.get("reply_count") or 0
+                rows.append(tuple(record.get(column) for column in columns))
+            flush()
+        except BaseException:
+            # the committed part of the load stays, but never leave the database without its indexes
+            conn.rollback()
+            cursor.execute("BEGIN")
+            restore_derived(cursor, derived, rebuild_paths=False)
+            conn.commit()
+            raise
+        restore_derived(cursor, derived, rebuild_paths)
+        conn.commit()
+
+        cursor.execute("PRAGMA foreign_key_check")
+        broken = cursor.fetchmany(10)
+        if broken:
+            print(f"load: warning, rows with dangling references, e.g. (table, rowid, parent, fk) {broken}")
+        cursor.execute("PRAGMA synchronous = NORMAL")
+        cursor.execute("PRAGMA foreign_keys = ON")
+        cursor.execute("ANALYZE")
+        conn.commit()
+    database.reload_boards()
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="export or import a onepop database as NDJSON")
+    commands = parser.add_subparsers(dest="command", required=True)
+    dumping = commands.add_parser("dump", help="write the forum to NDJSON")
+    dumping.add_argument("--db", default=config.DATABASE)
+    dumping.add_argument("--output", default="-", help="file to write, .gz is compressed, - for stdout")
+    loading = commands.add_parser("load", help="import NDJSON into a fresh database")
+    loading.add_argument("input", help="file to read, .gz is decompressed, - for stdin")
+    loading.add_argument("--db", default=config.DATABASE)
+    loading.add_argument("--batch", type=int, default=10000, help="rows per executemany")
+    loading.add_argument("--commit-every", type=int, default=500000, help="rows per transaction")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    # migrations and first setup print, keep them away from a dump on stdout
+    log = sys.stderr if args.command == "dump" and args.output == "-" else sys.stdout
+    with contextlib.redirect_stdout(log):
+        database = Database(args.db, pool_size=1, captcha_image_pool=0)
+
+    try:
+        if args.command == "dump":
+            with open_file(args.output, "w") as out:
+                counts = dump(database, out)
+        else:
+            with open_file(args.input, "r") as source:
+                counts = load(database, source, batch=args.batch, commit_every=args.commit_every)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        return 1
+    finally:
+        database.close()
+    print(f"{args.command}: {counts} in {time.perf_counter() - started:.1f}s", file=log)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
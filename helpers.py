@@ -1,13 +1,15 @@
 import random, string, hashlib
-from datetime import datetime
 import time
 
 import random
 import string
 import io
+import os
 from flask import Flask, send_file, request, make_response
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageDraw, ImageFont
 import uuid, json
+import re
+from markupsafe import Markup, escape
 
 def timestamp():
     return int(time.time())
@@ -37,23 +39,90 @@ def hash(input_string): # double sha256
     second_hash = hashlib.sha256(first_hash).hexdigest()
     return second_hash
 
-def check_pow(captcha_token, nonce, difficulty=14):
+def leading_zero_bits(digest):
+    """
+    Returns: number of zero bits at the start of digest (bytes)
+    """
+    return len(digest) * 8 - int.from_bytes(digest, "big").bit_length()
+
+def check_pow(captcha_token, nonce, difficulty):
+    """
+    Wave 1 proof of work: sha256 of the challenge has to start with `difficulty` zero bits.
+    The same check as static/popcap.js and testing_captcha.py.
+    Returns: valid or not, hex digest
+    """
     challenge = "popcap-" + captcha_token + "-popcap-" + nonce + "-popcap"
-    completed = hashlib.sha256(challenge.encode('utf-8')).hexdigest()
-    return (completed.count('0') >= difficulty, completed)
+    digest = hashlib.sha256(challenge.encode('utf-8')).digest()
+    return (leading_zero_bits(digest) >= difficulty, digest.hex())
+
+def make_cursor(key):
+    """
+    Turn an (updated_at, post_id) keyset position into a url-safe string.
+    """
+    if key is None:
+        return None
+    return f"{key[0]}.{key[1]}"
 
-def time_ago(timestamp):
+def parse_cursor(cursor):
+    """
+    Inverse of make_cursor. Returns None for missing or malformed cursors.
+    """
+    if not cursor:
+        return None
+    try:
+        updated_at, post_id = cursor.split(".")
+        return int(updated_at), int(post_id)
+    except ValueError:
+        return None
+
+COMMENT_PATH = re.compile(r"[0-9a-f]{8}(/[0-9a-f]{8})*")
+
+def parse_comment_cursor(cursor):
+    """
+    Check a comment window cursor (a comment path, see comment_path) from the url.
+    Returns: the path or None if it's missing or malformed
+    """
+    if not cursor or not COMMENT_PATH.fullmatch(cursor):
+        return None
+    return cursor
+
+def comment_path(parent_path, comment_id):
+    """
+    Materialized path of a comment: its ancestors' ids and its own as fixed width hex, joined by '/'.
+    Sorting by path gives the threaded reading order.
+    """
+    own = format(comment_id, "08x")
+    return parent_path + "/" + own if parent_path else own
+
+def fts_query(text, max_terms = 8):
+    """
+    Turn user input into a safe FTS5 query: every word quoted, all of them required.
+    Returns: query string or None if there's nothing to search for
+    """
+    terms = [term.replace('"', '""') for term in text.split()[:max_terms]]
+    if not terms:
+        return None
+    return " ".join(f'"{term}"' for term in terms)
+
+def highlight_snippet(snippet):
+    """
+    Escape an FTS5 snippet and turn its char(2)/char(3) match markers into <mark> tags.
+    """
+    escaped = escape(snippet or "")
+    return escaped.replace("\x02", Markup("<mark>")).replace("\x03", Markup("</mark>"))
+
+def time_ago(timestamp, now=None):
     """
     Convert a timestamp to a human-readable format like "x seconds/minutes/hours/days/weeks/months/years ago"
     Args:
     timestamp: timestamp in seconds since the epoch (output of time.time())
+    now: timestamp to measure from, defaults to the current time. Pass the same one for a whole page.
     Returns: A string representing the time difference in human-readable format
     """
-    now = datetime.now()
-    diff = now - datetime.fromtimestamp(timestamp)
-
-    second_diff = diff.seconds
-    day_diff = diff.days
+    if now is None:
+        now = time.time()
+    # same split as a timedelta: whole days, and the seconds left over
+    day_diff, second_diff = divmod(int(now) - int(timestamp), 86400)
 
     if day_diff < 0:
         return ''
@@ -81,16 +150,24 @@ def time_ago(timestamp):
         return str(day_diff // 30) + " months ago"
     return str(day_diff // 365) + " years ago"
 
+# maps a random byte onto 0..noise_factor, used to scale a whole noise image at once
+CAPTCHA_NOISE_FACTOR = 150
+CAPTCHA_NOISE_LUT = [v * (CAPTCHA_NOISE_FACTOR + 1) // 256 for v in range(256)] * 3
+
 def create_captcha_image(text):
+    """
+    Render the wave 2 image for text.
+    Returns: PNG bytes
+    """
     font = ImageFont.load_default(size=30)
 
     img_width = 100 + random.randrange(-10, 20)
     img_height = 40 + random.randrange(-4, 8)
-    background_color = (255, 255, 255) 
-    text_color = (0, 0, 0)       
+    size = (img_width, img_height)
 
-    img = Image.new('RGB', (img_width, img_height), color = background_color)
-    d = ImageDraw.Draw(img)
+    # draw the text as a coverage mask, fully covered pixels are "text", everything else background
+    mask = Image.new('L', size, color = 0)
+    d = ImageDraw.Draw(mask)
 
     bbox = d.textbbox((0, 0), text, font=font)
     text_width = bbox[2] - bbox[0]
@@ -99,20 +176,14 @@ def create_captcha_image(text):
     x = ((img_width - text_width) / 2) + random.randrange(-3, 3)
     y = ((img_height - text_height) / 2 - 5) + random.randrange(-3, 3)
 
-    d.text((x, y), text, fill=text_color, font=font)
-
-    pixels = img.load()
-    width, height = img.size
+    d.text((x, y), text, fill=255, font=font)
+    mask = mask.point(lambda v: 255 if v == 255 else 0)
 
-    noise_factor = 150
-    for i in range(width):
-        for j in range(height):
-            if pixels[i, j] == (0, 0, 0):
-                random_color = (random.randint(0, noise_factor), random.randint(0, noise_factor), random.randint(0, noise_factor))
-                pixels[i, j] = random_color
-            else:
-                random_color = (255 - random.randint(0, noise_factor), 255 - random.randint(0, noise_factor), 255 - random.randint(0, noise_factor))
-                pixels[i, j] = random_color
+    # per channel noise in 0..noise_factor for every pixel, generated for the whole buffer at once.
+    # text pixels get the dark noise, background pixels 255 - noise
+    noise = Image.frombytes('RGB', size, os.urandom(img_width * img_height * 3)).point(CAPTCHA_NOISE_LUT)
+    img = Image.composite(noise, ImageChops.invert(noise), mask)
+    d = ImageDraw.Draw(img)
 
     for _ in range(15):
         x1 = random.randint(0, img_width)
@@ -121,6 +192,5 @@ def create_captcha_image(text):
 
     byte_arr = io.BytesIO()
     img.save(byte_arr, format='PNG')
-    byte_arr.seek(0)
 
-    return byte_arr
\ No newline at end of file
+    return byte_arr.getvalue()
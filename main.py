@@ -1,99 +1,265 @@
-from flask import Flask, render_template, request, url_for, redirect, Response
+from flask import Flask, Blueprint, current_app, g, render_template, request, url_for, redirect, Response, send_from_directory, abort, make_response
+from markupsafe import Markup
+from werkzeug.local import LocalProxy
+from werkzeug.middleware.proxy_fix import ProxyFix
+import os
+import hashlib
+import json
+import mimetypes
 import sqlite3
 from database import Database
 import helpers
+import metrics
+import ratelimit
+import signal
+
+# all routes live on this blueprint, create_app() puts it on an app together with its Database
+bp = Blueprint("onepop", __name__)
+# the current app's Database, so routes can keep saying database.something()
+database = LocalProxy(lambda: current_app.extensions["onepop.database"])
+
+# endpoint -> rate limit group in config.RATE_LIMITS. Only the POSTs of login and signup, showing the forms is free
+RATE_LIMITED = {
+    ("onepop.captcha_w1", "GET"): "popcap",
+    ("onepop.captcha_w2", "GET"): "popcap",
+    ("onepop.create_post", "POST"): "create_post",
+    ("onepop.create_comment_route", "POST"): "create_comment",
+    ("onepop.handle_login", "POST"): "login",
+    ("onepop.handle_signup", "POST"): "signup",
+}
+
+def create_app(config=None):
+    """
+    Build the onepop app.
+    config: module, object or dict overriding the defaults in config.py
+    """
+    app = Flask("onepop", root_path=os.path.dirname(os.path.abspath(__file__)))
+    app.config.from_object("config")
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
+
+    metrics.configure(metrics=app.config["METRICS"], slow_query_ms=app.config["SLOW_QUERY_MS"])
+    if app.config["CAPTCHA_STORE"] == "signed" and not app.config["SECRET_KEY"]:
+        # fine for one process, captchas issued before a restart just stop working
+        app.config["SECRET_KEY"] = os.urandom(32)
+
+    test_mode = {}
+    if app.config["POPCAP_TEST_MODE"]:
+        print("popcap: TEST MODE, captchas are free to solve. Never run this on a public server!")
+        test_mode = {"captcha_difficulty": 0, "captcha_max_difficulty": 0, "captcha_test_solution": app.config["POPCAP_TEST_SOLUTION"]}
+    difficulty = {"captcha_difficulty": app.config["POPCAP_DIFFICULTY"],
+                  "captcha_max_difficulty": app.config["POPCAP_MAX_DIFFICULTY"],
+                  "captcha_busy_captchas": app.config["POPCAP_BUSY_CAPTCHAS"],
+                  "captcha_busy_writes": app.config["POPCAP_BUSY_WRITES"]}
+    app.extensions["onepop.database"] = Database(app.config["DATABASE"],
+                                                 pool_size=app.config["DB_POOL_SIZE"],
+                                                 captcha_store=app.config["CAPTCHA_STORE"],
+                                                 captcha_image_pool=app.config["CAPTCHA_IMAGE_POOL"],
+                                                 migrate=app.config["MIGRATE"],
+                                                 page_generation=app.config.get("PAGE_CACHE_GENERATION"),
+                                                 secret_key=app.config["SECRET_KEY"],
+                                                 captcha_shared_spent=app.config["CAPTCHA_SHARED_SPENT"],
+                                                 **{**difficulty, **test_mode})
+    # hashed asset names from build_static.py, empty without a build
+    app.extensions["onepop.assets"] = {}
+    manifest = os.path.join(app.root_path, "static", "build", "manifest.json")
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            app.extensions["onepop.assets"] = json.load(f)
+    app.extensions["onepop.ratelimit"] = ratelimit.RateLimiter(app.config["RATE_LIMITS"] or {},
+                                                              max_clients=app.config["RATE_LIMIT_CLIENTS"])
+    if app.config["TRUSTED_PROXIES"]:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["TRUSTED_PROXIES"])
+    app.register_blueprint(bp)
+    return app
+
+@bp.before_app_request
+def start_request():
+    # every "x minutes ago" on a page is measured from the same moment
+    g.now = helpers.timestamp()
+    if metrics.enabled:
+        metrics.start_request()
+    group = RATE_LIMITED.get((request.endpoint, request.method))
+    if group is not None:
+        wait = current_app.extensions["onepop.ratelimit"].hit(group, ratelimit.client_key(request.remote_addr))
+        if wait:
+            if metrics.enabled:
+                metrics.rate_limited_total.inc(group)
+            response = Response("Slow down, try again in a bit.", status=429, content_type="text/plain")
+            response.headers["Retry-After"] = str(int(wait) + 1)
+            return response
+
+@bp.after_app_request
+def record_metrics(response):
+    if metrics.enabled:
+        # the rule, not the path, so /post/1 and /post/2 end up in the same series
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.finish_request(route, request.method, response.status_code)
+    return response
 
-database = Database("onepop.db")
+@bp.get('/metrics')
+def metrics_endpoint():
+    if not metrics.enabled:
+        return "Metrics are disabled.", 404
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@bp.app_template_filter("time_ago")
+def time_ago_filter(timestamp):
+    return helpers.time_ago(timestamp, now=g.get("now"))
+
+@bp.app_template_global()
+def asset_url(name):
+    """
+    Returns: url of the built, fingerprinted version of a static asset, or None if there's no build
+    """
+    hashed = current_app.extensions["onepop.assets"].get(name)
+    return url_for("onepop.asset", filename=hashed) if hashed else None
+
+@bp.get('/assets/<filename>')
+def asset(filename):
+    # only what the manifest lists, the names change whenever the content does
+    if filename not in current_app.extensions["onepop.assets"].values():
+        abort(404)
+    build = os.path.join(current_app.root_path, "static", "build")
+    accepted = request.accept_encodings
+    # precompressed copies from build_static.py, best one the client takes
+    for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+        if accepted[encoding] and os.path.exists(os.path.join(build, filename + suffix)):
+            response = send_from_directory(build, filename + suffix, mimetype=mimetypes.guess_type(filename)[0])
+            response.headers["Content-Encoding"] = encoding
+            del response.headers["Content-Disposition"]
+            break
+    else:
+        response = send_from_directory(build, filename)
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
 
-app = Flask("onepop")
+# how long after its updated_at a page may still get writes stamped with that same second
+WRITE_SETTLE_SECONDS = 2
+
+def page_validators(kind, key, updated_at):
+    """
+    ETag and Last-Modified for a page that only changes with updated_at, the boards and who's looking at it.
+    Returns: (etag, last_modified), or (None, None) if the page can't be validated
+    """
+    now = helpers.timestamp()
+    # updated_at only has seconds, and writes stamp it on the writer thread before their batch
+    # commits, which can be in a later second. Until that has surely happened another write
+    # can still turn up with the same value without changing the tag
+    if updated_at is None or updated_at >= now - WRITE_SETTLE_SECONDS:
+        return None, None
+    # the "x minutes ago" texts age on their own, so no copy is good for longer than a minute
+    last_modified = max(updated_at, now - now % 60)
+    session = database.resolve_session(request.cookies.get("account"))
+    tag = f"{kind}:{key}:{updated_at}:{last_modified}:{database.boards.version}:{session.user_id if session else 0}"
+    return hashlib.sha1(tag.encode()).hexdigest()[:20], last_modified
+
+def add_validators(response, etag, last_modified):
+    # pages show who's logged in, so only the browser may keep them, and it has to ask every time
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.vary.add("Cookie")
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+        response.last_modified = last_modified
+    return response
 
-@app.get('/')
+def not_modified(etag, last_modified):
+    """
+    Returns: a 304 response if the client's copy is still current, otherwise None
+    """
+    if etag is None:
+        return None
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    else:
+        fresh = request.if_modified_since is not None and last_modified <= request.if_modified_since.timestamp()
+    return add_validators(Response(status=304), etag, last_modified) if fresh else None
+
+@bp.get('/')
 def index():
-    posts = database.all_newest_posts(page=int(request.args.get("page", 0)))
+    etag, last_modified = page_validators("board", "", database.board_updated_at())
+    response = not_modified(etag, last_modified)
+    if response:
+        return response
+    before, after = helpers.parse_cursor(request.args.get("before")), helpers.parse_cursor(request.args.get("after"))
+    key = database.pages.key(None, (before, after))
+    listing = database.pages.get(key)
+    if listing is None:
+        posts, older, newer = database.all_newest_posts(before=before, after=after)
+        listing = Markup(render_template("listing.html", boards=database.list_boards(), recent_posts=posts,
+                                         older_cursor=helpers.make_cursor(older), newer_cursor=helpers.make_cursor(newer)))
+        database.pages.set(key, listing)
     username = database.get_name_from_cookie(request.cookies.get("account"))
-    return render_template("index.html", boards=database.list_boards(), recent_posts=posts, current_page=int(request.args.get("page", 0)), username = username)
+    return add_validators(make_response(render_template("index.html", listing=listing, username = username)), etag, last_modified)
 
-@app.get('/board/<current_board>')
+@bp.get('/board/<current_board>')
 def index_board(current_board):
-    posts = database.newest_posts(current_board, page=int(request.args.get("page", 0)))
-    board_description = database.board_description(current_board)
+    etag, last_modified = page_validators("board", current_board, database.board_updated_at(current_board))
+    response = not_modified(etag, last_modified)
+    if response:
+        return response
+    before, after = helpers.parse_cursor(request.args.get("before")), helpers.parse_cursor(request.args.get("after"))
+    key = database.pages.key(current_board, (before, after))
+    listing = database.pages.get(key)
+    if listing is None:
+        posts, older, newer = database.newest_posts(current_board, before=before, after=after)
+        board_description = database.board_description(current_board)
+        listing = Markup(render_template("listing.html", boards=database.list_boards(), current_board=current_board, recent_posts=posts,
+                                         board_description=board_description, board_activity=database.board_activity(current_board),
+                                         older_cursor=helpers.make_cursor(older),
+                                         newer_cursor=helpers.make_cursor(newer)))
+        # don't let made up board names fill the cache
+        if database.board_id_from_name(current_board) is not None:
+            database.pages.set(key, listing)
+    username = database.get_name_from_cookie(request.cookies.get("account"))
+    return add_validators(make_response(render_template("index.html", listing=listing, username = username)), etag, last_modified)
+
+@bp.get('/search')
+def search():
+    query = request.args.get("q", "")[:256]
+    board = request.args.get("board") or None
+    # ranking has to look at every match, so don't let anyone page arbitrarily deep
+    page = min(max(request.args.get("page", 0, type=int), 0), 20)
+    results, more = database.search(query, board=board, page=page)
     username = database.get_name_from_cookie(request.cookies.get("account"))
-    return render_template("index.html", boards=database.list_boards(), current_board=current_board, recent_posts=posts,
-                           board_description=board_description, current_page=int(request.args.get("page", 0)), username = username)
+    return render_template("search.html", boards=database.list_boards(), results=results, query=query,
+                           current_board=board, current_page=page, more=more and page < 20, username = username)
 
-@app.get('/post/<int:post_id>')
+@bp.get('/post/<int:post_id>')
 def view_post(post_id):
-    post_obj = database.get_post_by_id(post_id)
-    if post_obj:
-        # Get the comment ID to which the user is replying from the query parameters
-        replying_to_comment_id = request.args.get('reply_to')
-        replying_to_comment = None
-
-        comments_list = database.get_comments_by_post_id(post_id)
-        comment_tree = database.build_comment_tree(comments_list)
-
-        username = database.get_name_from_cookie(request.cookies.get("account"))
-
-        # If a reply_to ID is provided, find the corresponding comment object
-        if replying_to_comment_id:
-            try:
-                replying_to_comment_id = int(replying_to_comment_id)
-                # Find the comment object in the flat list (or fetched specifically)
-                # Fetching it again is simpler here, but could be optimized
-                conn, cursor = database.handle()
-                cursor.execute("""
-                    SELECT
-                        c.comment_id, c.post_id, c.owner_id, c.parent_comment_id, c.content, c.created_at, c.updated_at, u.username AS owner_username
-                    FROM
-                        comments c
-                    LEFT JOIN
-                        users u ON c.owner_id = u.user_id
-                    WHERE
-                        c.comment_id = ? AND c.post_id = ?
-                    LIMIT 1
-                """, (replying_to_comment_id, post_id))
-                row = cursor.fetchone()
-                conn.close()
-
-                if row:
-                     replying_to_comment = {
-                        'comment_id': row[0],
-                        'post_id': row[1],
-                        'owner_id': row[2],
-                        'parent_comment_id': row[3],
-                        'content': row[4],
-                        'created_at': helpers.time_ago(row[5]),
-                        'updated_at': row[6],
-                        'owner': row[7] if row[7] is not None else 'Anonymous'
-                    }
-                else:
-                    # Invalid reply_to ID for this post, ignore it
-                    replying_to_comment_id = None
-
-            except (ValueError, TypeError):
-                # Handle cases where reply_to is not a valid integer
-                 replying_to_comment_id = None
-
-
-        return render_template(
-            "post.html",
-            post=post_obj,
-            comments=comment_tree,
-            replying_to_comment_id=replying_to_comment_id, # Pass the ID
-            replying_to_comment=replying_to_comment, # Pass the comment object for display
-            post_id=post_id, boards=database.list_boards(),
-            username = username
-        )
-    else:
-        return render_template("post.html", 
-                               boards=database.list_boards(), 
-                               post=None, comments=[], 
-                               replying_to_comment_id=None, 
-                               replying_to_comment=None, 
-                               post_id=post_id, 
-                               username = username)
-
-@app.post('/create_post')
+    # one primary key lookup decides whether the comments have to be loaded and rendered at all
+    etag, last_modified = page_validators("post", post_id, database.post_updated_at(post_id))
+    response = not_modified(etag, last_modified)
+    if response:
+        return response
+    thread = request.args.get('thread', type=int)
+    # a page of top level comments, or one thread when ?thread= is given
+    page = database.load_post_page(post_id, reply_to=request.args.get('reply_to', type=int), cookie=request.cookies.get("account"),
+                                   after=helpers.parse_comment_cursor(request.args.get('after')), thread=thread)
+    if page is None:
+        return render_template("post.html",
+                               boards=database.list_boards(),
+                               post=None, comments=[], thread=None, next_after=None,
+                               replying_to_comment_id=None,
+                               replying_to_comment=None,
+                               post_id=post_id,
+                               username = database.get_name_from_cookie(request.cookies.get("account"))), 404
+
+    return add_validators(make_response(render_template(
+        "post.html",
+        post=page.post,
+        comments=page.comments,
+        thread=thread, next_after=page.next_after,
+        replying_to_comment_id=page.replying_to.comment_id if page.replying_to else None,
+        replying_to_comment=page.replying_to, # Pass the comment object for display
+        post_id=post_id, boards=database.list_boards(),
+        username = page.session.username if page.session else None
+    )), etag, last_modified)
+
+@bp.post('/create_post')
 def create_post():
     owner = database.get_id_from_cookie(request.cookies.get("account"))
     image_url = None
@@ -118,7 +284,7 @@ def create_post():
 
     return redirect("/board/" + board)
 
-@app.post('/create_comment')
+@bp.post('/create_comment')
 def create_comment_route():
     post_id = request.form.get('post_id')
     content = request.form.get('content')
@@ -147,30 +313,33 @@ def create_comment_route():
         return "Invalid post_id or parent_comment_id", 400
     # Create the comment in the database
     database.new_comment(post_id, content, owner_id, parent_comment_id)
-    return redirect(url_for('view_post', post_id=post_id))
+    return redirect(url_for('onepop.view_post', post_id=post_id))
 
-@app.get('/popcap/wave1')
+@bp.get('/popcap/wave1')
 def captcha_w1():
-    captcha_token = database.captcha_create()
-    return captcha_token
-@app.get('/popcap/wave2')
+    captcha_token, difficulty = database.captcha_create()
+    # the client has to find a nonce whose hash starts with `difficulty` zero bits, see helpers.check_pow
+    return {"token": captcha_token, "difficulty": difficulty}
+@bp.get('/popcap/wave2')
 def captcha_w2():
     captcha_token = request.args.get("challenge_token")
     wave1_solution = request.args.get("nonce")
-    is_valid = database.captcha_check_wave_1(captcha_token, wave1_solution)
-    print(f"popcap: Wave 1 Submitted. tk={captcha_token} n={wave1_solution} v={is_valid}")
-    if not is_valid:
+    next_token = database.captcha_check_wave_1(captcha_token, wave1_solution)
+    print(f"popcap: Wave 1 Submitted. tk={captcha_token} n={wave1_solution} v={next_token is not None}")
+    if next_token is None:
         return "Invalid captcha."
-    wave2_challenge = database.captcha_get_wave_two_solution(captcha_token)
-    wave2_image = helpers.create_captcha_image(wave2_challenge)
+    wave2_image = database.captcha_image(captcha_token)
     response = Response(response=wave2_image, content_type="image/png")
+    # the token the form has to send with the answer, a new one for signed captchas
+    response.headers["X-Popcap-Token"] = next_token
+    response.headers["Cache-Control"] = "no-store"
     return response
 
-@app.get('/login')
+@bp.get('/login')
 def login():
     return render_template("login.html")
 
-@app.post('/login')
+@bp.post('/login')
 def handle_login():
     username = request.form.get("username")
     password = helpers.hash(request.form.get("password"))
@@ -190,10 +359,10 @@ def handle_login():
     response.set_cookie("account", cookie)
     return response
 
-@app.get('/signup')
+@bp.get('/signup')
 def signup():
     return render_template("signup.html")
-@app.post('/signup')
+@bp.post('/signup')
 def handle_signup():
     username = request.form.get("username")
     password = helpers.hash(request.form.get("password"))
@@ -214,11 +383,18 @@ def handle_signup():
     response.set_cookie("account", cookie)
     return response
 
-@app.get('/logout')
+@bp.get('/logout')
 def logout():
+    database.account_logout(request.cookies.get("account"))
     response = redirect("/")
     response.delete_cookie("account")
     return response
     
 
-app.run("0.0.0.0", port=8080)
\ No newline at end of file
+if __name__ == "__main__":
+    # development server, use serve.py in production
+    app = create_app()
+    # boards are cached in memory, `kill -HUP <pid>` picks up boards edited directly in onepop.db
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: app.extensions["onepop.database"].reload_boards())
+    app.run(app.config["HOST"], port=app.config["PORT"])
\ No newline at end of file
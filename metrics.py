@@ -0,0 +1,207 @@
+"""
+Request, sql and popcap instrumentation, exposed in the Prometheus text format on /metrics.
+
+Metrics live in module level registries, one set per process. With serve.py
+every worker counts for itself and /metrics shows the worker that happened to
+answer, so scrape the workers individually if you need exact totals.
+
+SQL is measured through TimedCursor, which Database.handle() hands out while
+instrumentation is on. Its timings cover execute()/executemany(), for most
+statements that is where sqlite does the work. Rows fetched afterwards aren't
+included. Writes run on the writer thread, which measures every job and hands
+the numbers back to the request that submitted it (see writer.py).
+"""
+import sqlite3
+import threading
+import time
+
+# set by configure(), see config.py
+enabled = True
+slow_query_seconds = None
+
+# the request the current thread is handling: [sql statements, sql seconds], or None outside of requests
+_current = threading.local()
+
+def configure(metrics=True, slow_query_ms=None):
+    global enabled, slow_query_seconds
+    enabled = metrics
+    slow_query_seconds = slow_query_ms / 1000 if slow_query_ms is not None else None
+
+def _label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter():
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values = {} # label values -> count
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_labels(self.label_names, labels)} {value}")
+        return lines
+
+class Histogram():
+    """
+    Cumulative buckets like Prometheus expects them, plus sum and count.
+    """
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.label_names = tuple(labels)
+        self.series = {} # label values -> [count per bucket..., count above the last bucket, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        # first bucket the value fits in, the slot after the buckets is +Inf
+        slot = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                slot = i
+                break
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [0] * (len(self.buckets) + 2)
+            series[slot] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, series in sorted(self.series.items()):
+                total = 0
+                for bound, count in zip((*self.buckets, "+Inf"), series):
+                    total += count
+                    le = f'le="{bound}"'
+                    lines.append(f"{self.name}_bucket{_labels(self.label_names, labels, le)} {total}")
+                lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {series[-1]}")
+                lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {total}")
+        return lines
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+requests_total = Counter("onepop_requests_total", "Requests handled", labels=("route", "method", "status"))
+request_seconds = Histogram("onepop_request_seconds", "Time spent handling a request", LATENCY_BUCKETS, labels=("route", "method"))
+request_sql_statements = Histogram("onepop_request_sql_statements", "SQL statements executed per request",
+                                   (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100), labels=("route",))
+request_sql_seconds = Histogram("onepop_request_sql_seconds", "Time spent in SQL per request", LATENCY_BUCKETS, labels=("route",))
+slow_queries_total = Counter("onepop_slow_queries_total", "SQL statements slower than SLOW_QUERY_MS")
+captcha_total = Counter("onepop_captcha_total", "Popcap captchas by event: issued, wave1_passed, wave1_failed, wave2_passed, wave2_failed",
+                        labels=("event",))
+rate_limited_total = Counter("onepop_rate_limited_total", "Requests refused with 429 by the rate limiter", labels=("group",))
+pow_verify_seconds = Histogram("onepop_pow_verify_seconds", "Time spent verifying a wave 1 proof of work",
+                               (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.001))
+pow_difficulty = Histogram("onepop_pow_difficulty", "Wave 1 difficulty (leading zero bits) of issued captchas", range(0, 33, 2))
+writer_batch_jobs = Histogram("onepop_writer_batch_jobs", "Write jobs committed together in one transaction",
+                              (1, 2, 3, 5, 8, 13, 21, 34, 64))
+writer_batch_seconds = Histogram("onepop_writer_batch_seconds", "Time from BEGIN IMMEDIATE to COMMIT of a write batch", LATENCY_BUCKETS)
+writer_wait_seconds = Histogram("onepop_writer_wait_seconds", "Time a write waited for the writer thread until it was committed",
+                                LATENCY_BUCKETS)
+
+METRICS = (requests_total, request_seconds, request_sql_statements, request_sql_seconds, slow_queries_total,
+           captcha_total, rate_limited_total, pow_verify_seconds, pow_difficulty,
+           writer_batch_jobs, writer_batch_seconds, writer_wait_seconds)
+
+def render():
+    """
+    Returns: every metric in the Prometheus text exposition format
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+#### REQUESTS ####
+
+def start_request():
+    _current.stats = [0, 0.0]
+    _current.started = time.perf_counter()
+
+def finish_request(route, method, status):
+    stats = getattr(_current, "stats", None)
+    if stats is None:
+        return
+    _current.stats = None
+    requests_total.inc(route, method, status)
+    request_seconds.observe(time.perf_counter() - _current.started, route, method)
+    request_sql_statements.observe(stats[0], route)
+    request_sql_seconds.observe(stats[1], route)
+
+def count_queries(stats):
+    """
+    Count the SQL of the current thread into stats ([statements, seconds]) from now on, None stops.
+    The writer thread uses it to measure every job on its own.
+    """
+    _current.stats = stats
+
+def add_queries(stats):
+    """
+    Add SQL that ran on another thread for the current request, e.g. its writes on the writer thread.
+    """
+    current = getattr(_current, "stats", None)
+    if current is not None:
+        current[0] += stats[0]
+        current[1] += stats[1]
+
+#### SQL ####
+
+def parameters_shape(parameters):
+    """
+    Types (and lengths of strings/blobs) of query parameters without their values,
+    e.g. (int, str[36]), so slow query logs don't leak passwords or cookies.
+    """
+    def shape(value):
+        if isinstance(value, (str, bytes)):
+            return f"{type(value).__name__}[{len(value)}]"
+        return type(value).__name__
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{key}: {shape(value)}" for key, value in parameters.items()) + "}"
+    return "(" + ", ".join(shape(value) for value in parameters) + ")"
+
+def record_query(sql, parameters, seconds, many=False):
+    stats = getattr(_current, "stats", None)
+    if stats is not None:
+        stats[0] += 1
+        stats[1] += seconds
+    if slow_query_seconds is not None and seconds >= slow_query_seconds:
+        slow_queries_total.inc()
+        if many:
+            parameters = f"{len(parameters)} rows" if isinstance(parameters, list) else "iterator"
+        else:
+            parameters = parameters_shape(parameters)
+        print(f"db: slow query {seconds * 1000:.1f}ms: {' '.join(sql.split())} params={parameters}")
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    Cursor that reports every statement to record_query().
+    Usage: conn.cursor(TimedCursor)
+    """
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record_query(sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(sql, seq_of_parameters, time.perf_counter() - started, many=True)
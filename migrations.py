@@ -0,0 +1,322 @@
+"""
+Schema migrations for the onepop database.
+
+The schema version lives in PRAGMA user_version. Every function in
+MIGRATIONS takes the schema from version N to N+1 and runs inside one
+transaction together with the version bump, so a crash mid-migration
+leaves the file at the old version.
+Never edit a migration that has shipped, append a new one instead.
+"""
+
+def v1_tables(cursor):
+    # The original schema. Uses IF NOT EXISTS because databases created before
+    # migrations existed are at user_version 0 but already have these tables.
+
+    # roles table for permission management
+    # ID, Name (e.g., 'user', 'moderator', 'admin')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS roles (
+                role_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT UNIQUE NOT NULL
+            )''')
+
+    # boards table for categorizing posts
+    # ID, Name, Description
+    # Note: Simple independent boards. If a hierarchy is needed, add a parent_board_id
+    cursor.execute('''CREATE TABLE IF NOT EXISTS boards (
+                board_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT UNIQUE NOT NULL,
+                description TEXT
+            )''')
+
+    # users table
+    # Added role_id foreign key
+    cursor.execute('''CREATE TABLE IF NOT EXISTS users (
+                user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                password TEXT NOT NULL, -- Should store password hash
+                cookie TEXT UNIQUE, -- For remember me functionality, optional
+                role_id INTEGER DEFAULT 1, -- Default role_id, e.g., 1 for 'user'
+                FOREIGN KEY (role_id) REFERENCES roles (role_id)
+            )''')
+
+    # posts table
+    # Changed board TEXT to board_id INTEGER FOREIGN KEY
+    # Removed Reputation (JSON) and Lastrep
+    # Added total_upvotes for quick access
+    cursor.execute('''CREATE TABLE IF NOT EXISTS posts (
+                post_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                board_id INTEGER NOT NULL, -- Link to the boards table
+                owner_id INTEGER, -- Link to the users table (can be NULL for anonymous)
+                title TEXT,
+                description TEXT, -- Or content for the main post body
+                image_url TEXT, -- Added field for image URL/path
+                created_at INTEGER NOT NULL,
+                updated_at INTEGER NOT NULL, -- To track last activity
+                FOREIGN KEY (board_id) REFERENCES boards (board_id),
+                FOREIGN KEY (owner_id) REFERENCES users (user_id)
+            )''')
+
+    # Note: You might want a separate table for post images if multiple images per post are allowed.
+
+    # comments table
+    cursor.execute('''CREATE TABLE IF NOT EXISTS comments (
+                comment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                post_id INTEGER NOT NULL, -- Link to the posts table
+                owner_id INTEGER, -- Link to the users table (can be NULL for anonymous)
+                parent_comment_id INTEGER, -- Link to parent comment for threading
+                content TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                updated_at INTEGER NOT NULL, -- To track last activity
+                FOREIGN KEY (post_id) REFERENCES posts (post_id),
+                FOREIGN KEY (owner_id) REFERENCES users (user_id),
+                FOREIGN KEY (parent_comment_id) REFERENCES comments (comment_id)
+            )''')
+
+    # for captchas
+    cursor.execute('''CREATE TABLE IF NOT EXISTS captchas (
+                captcha_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                captcha_token TEXT NOT NULL,
+                created_at INTEGER NOT NULL,
+                wave INTEGER NOT NULL,
+                wave_two_solution TEXT NOT NULL
+            )''')
+
+def v2_indexes(cursor):
+    # front page: ORDER BY updated_at DESC without sorting the whole table
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_updated ON posts (updated_at)")
+    # board pages: WHERE board_id = ? ORDER BY updated_at DESC
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_posts_board_updated ON posts (board_id, updated_at)")
+    # post page: all comments of one post
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_comments_post_created ON comments (post_id, created_at)")
+
+    # every captcha check looks up by token. tokens are uuid4 so duplicates
+    # should never exist, but drop any before making the index unique.
+    cursor.execute("""DELETE FROM captchas WHERE captcha_id NOT IN (
+                        SELECT MIN(captcha_id) FROM captchas GROUP BY captcha_token
+                    )""")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_captchas_token ON captchas (captcha_token)")
+    # captcha_purge deletes by age
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_captchas_created ON captchas (created_at)")
+
+def v3_comment_paths(cursor):
+    # Materialized paths for threaded comments. A comment's path is its
+    # ancestors' ids and its own id as 8 digit hex joined by '/', e.g.
+    # 0000002a/0000002f/00000031, so ORDER BY path is the depth first reading
+    # order and a subtree is one contiguous range of the (post_id, path) index.
+    cursor.execute("ALTER TABLE comments ADD COLUMN path TEXT")
+    cursor.execute("ALTER TABLE comments ADD COLUMN depth INTEGER NOT NULL DEFAULT 0")
+    # direct replies, so the page knows when a thread continues beyond what it loaded
+    cursor.execute("ALTER TABLE comments ADD COLUMN reply_count INTEGER NOT NULL DEFAULT 0")
+
+    backfill_comment_paths(cursor)
+
+    # subtree and window loads: WHERE post_id = ? AND path range, depth checked from the index
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_comments_post_path ON comments (post_id, path, depth)")
+    # top level comments of a post, paged by id
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_comments_post_roots ON comments (post_id, comment_id) WHERE parent_comment_id IS NULL")
+
+def backfill_comment_paths(cursor):
+    """
+    Recompute path, depth and reply_count of every comment from parent_comment_id.
+    """
+    # old replies to a comment of another post become top level comments of their own post,
+    # like new_comment does with them now. Otherwise they'd end up in the other post's tree
+    cursor.execute("""UPDATE comments SET parent_comment_id = NULL
+                        WHERE parent_comment_id IS NOT NULL AND EXISTS (
+                            SELECT 1 FROM comments p WHERE p.comment_id = comments.parent_comment_id AND p.post_id != comments.post_id)""")
+
+    # backfill through temp tables so every update is a primary key lookup
+    cursor.execute("CREATE TEMP TABLE comment_paths (comment_id INTEGER PRIMARY KEY, path TEXT, depth INTEGER)")
+    cursor.execute("""
+        WITH RECURSIVE tree(comment_id, post_id, path, depth) AS (
+            SELECT comment_id, post_id, printf('%08x', comment_id), 0 FROM comments WHERE parent_comment_id IS NULL
+            UNION ALL
+            SELECT c.comment_id, c.post_id, tree.path || '/' || printf('%08x', c.comment_id), tree.depth + 1
+            FROM comments c JOIN tree ON c.parent_comment_id = tree.comment_id AND c.post_id = tree.post_id
+        )
+        INSERT INTO comment_paths SELECT comment_id, path, depth FROM tree
+    """)
+    cursor.execute("""UPDATE comments SET
+                        path = (SELECT p.path FROM comment_paths p WHERE p.comment_id = comments.comment_id),
+                        depth = COALESCE((SELECT p.depth FROM comment_paths p WHERE p.comment_id = comments.comment_id), 0)""")
+    cursor.execute("DROP TABLE comment_paths")
+    # replies whose parent no longer exists keep a NULL path and stay hidden, like before
+
+    cursor.execute("CREATE TEMP TABLE comment_replies (comment_id INTEGER PRIMARY KEY, reply_count INTEGER)")
+    cursor.execute("""INSERT INTO comment_replies
+                        SELECT parent_comment_id, COUNT(*) FROM comments
+                        WHERE parent_comment_id IS NOT NULL GROUP BY parent_comment_id""")
+    cursor.execute("""UPDATE comments SET reply_count = (SELECT r.reply_count FROM comment_replies r WHERE r.comment_id = comments.comment_id)
+                        WHERE comment_id IN (SELECT comment_id FROM comment_replies)""")
+    cursor.execute("DROP TABLE comment_replies")
+
+def v4_search(cursor):
+    # Full text search over posts and comments. The fts tables only hold the
+    # index (external content), the text itself stays in posts/comments.
+    cursor.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts USING fts5(
+                        title, description, content='posts', content_rowid='post_id',
+                        tokenize='unicode61 remove_diacritics 2')""")
+    cursor.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS comments_fts USING fts5(
+                        content, content='comments', content_rowid='comment_id',
+                        tokenize='unicode61 remove_diacritics 2')""")
+
+    # Keep them in sync from the write paths. The UPDATE triggers only fire for
+    # the indexed columns, so bumping updated_at on every comment costs nothing.
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS posts_fts_insert AFTER INSERT ON posts BEGIN
+                        INSERT INTO posts_fts (rowid, title, description) VALUES (new.post_id, new.title, new.description);
+                    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS posts_fts_delete AFTER DELETE ON posts BEGIN
+                        INSERT INTO posts_fts (posts_fts, rowid, title, description) VALUES ('delete', old.post_id, old.title, old.description);
+                    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS posts_fts_update AFTER UPDATE OF title, description ON posts BEGIN
+                        INSERT INTO posts_fts (posts_fts, rowid, title, description) VALUES ('delete', old.post_id, old.title, old.description);
+                        INSERT INTO posts_fts (rowid, title, description) VALUES (new.post_id, new.title, new.description);
+                    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS comments_fts_insert AFTER INSERT ON comments BEGIN
+                        INSERT INTO comments_fts (rowid, content) VALUES (new.comment_id, new.content);
+                    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS comments_fts_delete AFTER DELETE ON comments BEGIN
+                        INSERT INTO comments_fts (comments_fts, rowid, content) VALUES ('delete', old.comment_id, old.content);
+                    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS comments_fts_update AFTER UPDATE OF content ON comments BEGIN
+                        INSERT INTO comments_fts (comments_fts, rowid, content) VALUES ('delete', old.comment_id, old.content);
+                        INSERT INTO comments_fts (rowid, content) VALUES (new.comment_id, new.content);
+                    END""")
+
+    # backfill whatever was posted before search existed
+    rebuild_search(cursor)
+
+def rebuild_search(cursor):
+    cursor.execute("INSERT INTO posts_fts (posts_fts) VALUES ('rebuild')")
+    cursor.execute("INSERT INTO comments_fts (comments_fts) VALUES ('rebuild')")
+
+def v5_activity(cursor):
+    # Counters and last activity kept on the rows the listings already read, so
+    # showing them costs nothing per post. Triggers keep them right inside the
+    # transaction of every write, whatever code path the write came from.
+    cursor.execute("ALTER TABLE posts ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("ALTER TABLE posts ADD COLUMN last_comment_at INTEGER")
+    cursor.execute("ALTER TABLE posts ADD COLUMN last_commenter_id INTEGER REFERENCES users (user_id)")
+    cursor.execute("ALTER TABLE boards ADD COLUMN post_count INTEGER NOT NULL DEFAULT 0")
+    cursor.execute("ALTER TABLE boards ADD COLUMN comment_count INTEGER NOT NULL DEFAULT 0")
+
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS posts_activity_insert AFTER INSERT ON posts BEGIN
+                        UPDATE boards SET post_count = post_count + 1, comment_count = comment_count + new.comment_count
+                        WHERE board_id = new.board_id;
+                    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS posts_activity_delete AFTER DELETE ON posts BEGIN
+                        UPDATE boards SET post_count = post_count - 1, comment_count = comment_count - old.comment_count
+                        WHERE board_id = old.board_id;
+                    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS posts_activity_move AFTER UPDATE OF board_id ON posts
+                    WHEN new.board_id IS NOT old.board_id BEGIN
+                        UPDATE boards SET post_count = post_count - 1, comment_count = comment_count - old.comment_count
+                        WHERE board_id = old.board_id;
+                        UPDATE boards SET post_count = post_count + 1, comment_count = comment_count + new.comment_count
+                        WHERE board_id = new.board_id;
+                    END""")
+    # the right hand sides all see the row from before the update, so the commenter
+    # only changes if this comment is at least as new as the last one
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS comments_activity_insert AFTER INSERT ON comments BEGIN
+                        UPDATE posts SET
+                            comment_count = comment_count + 1,
+                            last_commenter_id = CASE WHEN last_comment_at IS NULL OR new.created_at >= last_comment_at
+                                                     THEN new.owner_id ELSE last_commenter_id END,
+                            last_comment_at = MAX(COALESCE(last_comment_at, new.created_at), new.created_at)
+                        WHERE post_id = new.post_id;
+                        UPDATE boards SET comment_count = comment_count + 1
+                        WHERE board_id = (SELECT board_id FROM posts WHERE post_id = new.post_id);
+                    END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS comments_activity_delete AFTER DELETE ON comments BEGIN
+                        UPDATE posts SET
+                            comment_count = comment_count - 1,
+                            last_comment_at = (SELECT created_at FROM comments WHERE post_id = old.post_id
+                                               ORDER BY created_at DESC, comment_id DESC LIMIT 1),
+                            last_commenter_id = (SELECT owner_id FROM comments WHERE post_id = old.post_id
+                                                 ORDER BY created_at DESC, comment_id DESC LIMIT 1)
+                        WHERE post_id = old.post_id;
+                        UPDATE boards SET comment_count = comment_count - 1
+                        WHERE board_id = (SELECT board_id FROM posts WHERE post_id = old.post_id);
+                    END""")
+
+    backfill_activity(cursor)
+
+def backfill_activity(cursor):
+    """
+    Recompute the counters and last activity of every post and board.
+    """
+    cursor.execute("UPDATE posts SET comment_count = 0, last_comment_at = NULL, last_commenter_id = NULL")
+    cursor.execute("CREATE TEMP TABLE post_activity (post_id INTEGER PRIMARY KEY, comment_count INTEGER, last_comment_at INTEGER)")
+    cursor.execute("""INSERT INTO post_activity
+                        SELECT post_id, COUNT(*), MAX(created_at) FROM comments GROUP BY post_id""")
+    # newest comment of a post is one step backwards through idx_comments_post_created
+    cursor.execute("""UPDATE posts SET
+                        comment_count = (SELECT a.comment_count FROM post_activity a WHERE a.post_id = posts.post_id),
+                        last_comment_at = (SELECT a.last_comment_at FROM post_activity a WHERE a.post_id = posts.post_id),
+                        last_commenter_id = (SELECT c.owner_id FROM comments c WHERE c.post_id = posts.post_id
+                                             ORDER BY c.created_at DESC, c.comment_id DESC LIMIT 1)
+                        WHERE post_id IN (SELECT post_id FROM post_activity)""")
+    cursor.execute("DROP TABLE post_activity")
+    cursor.execute("""UPDATE boards SET
+                        post_count = (SELECT COUNT(*) FROM posts p WHERE p.board_id = boards.board_id),
+                        comment_count = (SELECT COALESCE(SUM(p.comment_count), 0) FROM posts p WHERE p.board_id = boards.board_id)""")
+
+def v6_captcha_difficulty(cursor):
+    # every captcha gets its own wave 1 difficulty, see captcha.DifficultyController.
+    # captchas issued before the upgrade keep the old bar of roughly 16 bits
+    cursor.execute("ALTER TABLE captchas ADD COLUMN difficulty INTEGER NOT NULL DEFAULT 16")
+
+def v7_captcha_spent(cursor):
+    # ids of used up signed captchas, shared by every process, see captcha.SQLiteSpentTokens.
+    # bucket is issued_at // CAPTCHA_TTL, whole buckets get purged once they can't be checked anymore
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS captcha_spent (
+            captcha_id TEXT PRIMARY KEY,
+            bucket INTEGER NOT NULL
+        ) WITHOUT ROWID
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_captcha_spent_bucket ON captcha_spent (bucket)")
+
+MIGRATIONS = [
+    v1_tables,
+    v2_indexes,
+    v3_comment_paths,
+    v4_search,
+    v5_activity,
+    v6_captcha_difficulty,
+    v7_captcha_spent,
+]
+
+def schema_version(cursor):
+    cursor.execute("PRAGMA user_version")
+    return cursor.fetchone()[0]
+
+def migrate(conn):
+    """
+    Bring the database up to the newest schema version.
+    Returns: (version before, version after)
+    """
+    cursor = conn.cursor()
+    start = schema_version(cursor)
+    target = len(MIGRATIONS)
+    if start >= target:
+        return start, start
+
+    for version in range(start, target):
+        print(f"db: migrating schema {version} -> {version + 1}")
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            # re-check under the write lock in case another process got here first
+            if schema_version(cursor) > version:
+                conn.rollback()
+                continue
+            MIGRATIONS[version](cursor)
+            cursor.execute(f"PRAGMA user_version = {version + 1}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    # refresh planner statistics for the new indexes
+    cursor.execute("PRAGMA optimize")
+    return start, target
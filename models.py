@@ -0,0 +1,72 @@
+"""
+Row types for what the pages show. Plain classes with __slots__: a big comment
+page builds thousands of these, and they're much smaller and quicker to make
+than a dict per row. Timestamps stay raw integers, templates format them with
+the time_ago filter against one "now" per request.
+
+Use from_row as the cursor's row_factory for a query that selects exactly the
+columns of __init__, in that order.
+"""
+
+class Post():
+    __slots__ = ("post_id", "title", "description", "image_url", "created_at", "updated_at", "board", "owner",
+                 "comment_count", "last_comment_at", "last_commenter")
+
+    def __init__(self, post_id, title, description, image_url, created_at, updated_at, board, owner,
+                 comment_count = 0, last_comment_at = None, last_commenter = None):
+        self.post_id = post_id
+        self.title = title
+        self.description = description
+        self.image_url = image_url
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.board = board
+        self.owner = owner if owner is not None else 'Anonymous'
+        # kept up to date by triggers, see migrations.v5_activity
+        self.comment_count = comment_count
+        self.last_comment_at = last_comment_at # None if nobody commented yet
+        self.last_commenter = last_commenter if last_commenter is not None else 'Anonymous'
+
+    @classmethod
+    def from_row(cls, cursor, row):
+        return cls(*row)
+
+class Comment():
+    __slots__ = ("comment_id", "post_id", "owner_id", "parent_comment_id", "content", "created_at", "updated_at", "owner",
+                 "depth", "reply_count", "path", "replies")
+
+    def __init__(self, comment_id, post_id, owner_id, parent_comment_id, content, created_at, updated_at, owner,
+                 depth = 0, reply_count = 0, path = None):
+        self.comment_id = comment_id
+        self.post_id = post_id
+        self.owner_id = owner_id
+        self.parent_comment_id = parent_comment_id
+        self.content = content
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.owner = owner if owner is not None else 'Anonymous'
+        self.depth = depth
+        self.reply_count = reply_count
+        self.path = path # only loaded with comment windows, see Database.read_comment_window
+        self.replies = [] # filled in when the comments are put into a tree
+
+    @classmethod
+    def from_row(cls, cursor, row):
+        return cls(*row)
+
+class SearchResult():
+    __slots__ = ("post_id", "comment_id", "title", "snippet", "created_at", "board", "owner", "rank")
+
+    def __init__(self, post_id, comment_id, title, snippet, created_at, board, owner, rank):
+        self.post_id = post_id
+        self.comment_id = comment_id # None if the post itself matched
+        self.title = title
+        self.snippet = snippet # raw fts snippet, see helpers.highlight_snippet
+        self.created_at = created_at
+        self.board = board
+        self.owner = owner if owner is not None else 'Anonymous'
+        self.rank = rank
+
+    @classmethod
+    def from_row(cls, cursor, row):
+        return cls(*row)
@@ -0,0 +1,79 @@
+"""
+Per client token bucket rate limiting, in memory.
+
+Every (group, client) pair gets a bucket that holds up to `burst` requests
+and refills at `per_minute` requests per minute. A request takes a token or
+is refused, main.py answers refused ones with 429 before they touch the
+database. Buckets are two numbers in an LRU bounded by max_clients: a bucket
+that went idle has refilled completely and looks just like one that was never
+created, so dropping the least recently used ones loses nothing that matters.
+
+Like the page cache, buckets belong to one server process. With serve.py each
+worker counts for itself, so a client that gets spread over the workers can
+do up to workers times the configured rate.
+"""
+import ipaddress
+import threading
+import time
+from collections import OrderedDict
+
+class RateLimiter():
+    """
+    limits: group -> (requests per minute, burst), groups missing or set to None aren't limited
+    max_clients: buckets kept before the least recently used ones are dropped
+    """
+    def __init__(self, limits, max_clients=100000):
+        self.rates = {}
+        for group, limit in limits.items():
+            if limit is not None:
+                per_minute, burst = limit
+                self.rates[group] = (per_minute / 60, burst)
+        self.max_clients = max_clients
+        self.buckets = OrderedDict() # (group, client) -> (tokens, last refill)
+        self.lock = threading.Lock()
+
+    def hit(self, group, client):
+        """
+        Take a token from the client's bucket for group.
+        Returns: 0 if the request may go ahead, otherwise seconds until it would
+        """
+        rate = self.rates.get(group)
+        if rate is None:
+            return 0
+        per_second, burst = rate
+        key = (group, client)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                tokens = burst
+            else:
+                tokens = min(burst, bucket[0] + (now - bucket[1]) * per_second)
+                self.buckets.move_to_end(key)
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now)
+                wait = 0
+            else:
+                self.buckets[key] = (tokens, now)
+                wait = (1 - tokens) / per_second
+            while len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        return wait
+
+    def __len__(self):
+        return len(self.buckets)
+
+def client_key(address):
+    """
+    What a client is counted as: its IPv4 address, or its /64 for IPv6,
+    since anyone with one IPv6 address can use the whole /64 it's in.
+    """
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return address # unix sockets, test clients, ...
+    if ip.version == 6:
+        if ip.ipv4_mapped is not None:
+            return str(ip.ipv4_mapped)
+        return str(ipaddress.ip_network((ip, 64), strict=False))
+    return str(ip)
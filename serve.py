@@ -0,0 +1,135 @@
+"""
+Production entry point for onepop.
+
+    python serve.py [--host HOST] [--port PORT] [--workers N]
+
+The parent process upgrades the schema once, opens the listening socket and
+forks N worker processes that all accept on it. Every worker builds its own
+app with its own Database (sqlite connections never cross a fork) and serves
+requests on threads. The parent only supervises: it restarts workers that
+die, forwards SIGHUP (reload boards) and on SIGTERM/SIGINT stops the workers,
+which finish their in-flight requests before exiting.
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+
+from werkzeug.serving import make_server
+
+import config
+from database import Database
+from main import create_app
+
+def run_worker(sock, settings):
+    app = create_app(settings)
+    database = app.extensions["onepop.database"]
+    server = make_server(settings["HOST"], settings["PORT"], app, threaded=True, fd=sock.fileno())
+    # let server_close() wait for requests that are still running instead of killing them
+    server.daemon_threads = False
+    server.block_on_close = True
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, so it can't run on this thread
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: database.reload_boards())
+
+    print(f"serve: worker {os.getpid()} ready")
+    server.serve_forever()
+    server.server_close()
+    database.close()
+    print(f"serve: worker {os.getpid()} stopped")
+
+def spawn(sock, settings):
+    pid = os.fork()
+    if pid == 0:
+        # drop the supervisor's handlers until run_worker installs its own
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, signal.SIG_DFL)
+        code = 0
+        try:
+            run_worker(sock, settings)
+        except Exception as e:
+            print(f"serve: worker {os.getpid()} crashed: {e}")
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+def main():
+    parser = argparse.ArgumentParser(description="run onepop with pre-forked worker processes")
+    parser.add_argument("--host", default=config.HOST)
+    parser.add_argument("--port", type=int, default=config.PORT)
+    parser.add_argument("--workers", type=int, default=config.WORKERS, help="0 = one per cpu core")
+    args = parser.parse_args()
+
+    workers = args.workers or os.cpu_count() or 1
+    if not hasattr(os, "fork"):
+        print("serve: this platform can't fork, running a single worker")
+        workers = 1
+
+    settings = {"HOST": args.host, "PORT": args.port, "MIGRATE": False, "CAPTCHA_SHARED_SPENT": False}
+    if workers > 1:
+        if config.CAPTCHA_STORE == "memory":
+            # a captcha issued by one worker has to be checkable by all of them
+            print("serve: CAPTCHA_STORE 'memory' only works in one process, using 'sqlite'")
+            settings["CAPTCHA_STORE"] = "sqlite"
+        settings["PAGE_CACHE_GENERATION"] = multiprocessing.Value("L", 0)
+        if config.CAPTCHA_STORE == "signed" and not config.SECRET_KEY:
+            # every worker has to check the tokens the others signed
+            settings["SECRET_KEY"] = os.urandom(32)
+        if config.CAPTCHA_STORE == "signed":
+            settings["CAPTCHA_SHARED_SPENT"] = config.CAPTCHA_SHARED_SPENT
+            if not config.CAPTCHA_SHARED_SPENT:
+                print(f"serve: signed captchas are spent per worker, a solved one can be used up to {workers} times "
+                      "(CAPTCHA_SHARED_SPENT = True to prevent that)")
+
+    # schema checks and first time setup happen exactly once, before any worker exists
+    Database(config.DATABASE, pool_size=1, captcha_image_pool=0).close()
+
+    sock = socket.create_server((args.host, args.port), backlog=1024)
+    sock.set_inheritable(True)
+    print(f"serve: listening on {args.host}:{args.port} with {workers} workers")
+
+    if workers == 1:
+        run_worker(sock, settings)
+        return
+
+    children = set()
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, lambda signum, frame: [os.kill(pid, signal.SIGHUP) for pid in children])
+
+    for _ in range(workers):
+        children.add(spawn(sock, settings))
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not stopping:
+            print(f"serve: worker {pid} exited with status {status}, restarting it")
+            children.add(spawn(sock, settings))
+
+    sock.close()
+    print("serve: stopped")
+
+if __name__ == "__main__":
+    sys.exit(main())
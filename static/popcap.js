@@ -3,12 +3,96 @@
 // by (c) Zander, 2025
 // Released under GPLv3
 
-async function generateSHA256Hash(data) {
-    const msgUint8 = new TextEncoder().encode(data);
-    const hashBuffer = await crypto.subtle.digest('SHA-256', msgUint8);
-    const hashArray = Array.from(new Uint8Array(hashBuffer));
-    const hashHex = hashArray.map(b => b.toString(16).padStart(2, '0')).join('');
-    return hashHex;
+// The proof of work runs in Web Workers so the page never freezes, one per core
+// by default (set data-workers="n" on #pow-captcha to change that). Every worker
+// tries its own share of the nonces (start, start + step, start + 2 * step, ...)
+// in batches of digests and reports its progress back here. Where workers aren't
+// available it falls back to the same search on the page itself.
+// The server checks the same thing as always, see helpers.check_pow.
+
+const POPCAP_BATCH = 256; // digests in flight at once per worker
+const POPCAP_REPORT_MS = 200; // how often workers report progress
+
+// number of zero bits at the start of the hash, same as helpers.leading_zero_bits on the server
+function leadingZeroBits(bytes) {
+    let bits = 0;
+    for (const byte of bytes) {
+        if (byte === 0) {
+            bits += 8;
+            continue;
+        }
+        return bits + Math.clz32(byte) - 24;
+    }
+    return bits;
+}
+
+// Looks for a nonce whose sha256("popcap-<token>-popcap-<nonce>-popcap") starts with
+// `difficulty` zero bits. Runs in the workers (its source is copied into them) and on the page.
+// onProgress(hashes since the last report, best zero bits so far)
+async function searchNonces(captchaToken, difficulty, start, step, onProgress) {
+    const encoder = new TextEncoder();
+    const prefix = encoder.encode("popcap-" + captchaToken + "-popcap-");
+    const suffix = encoder.encode("-popcap");
+    // digest() copies its input right away, so one buffer does for the whole batch
+    const buffer = new Uint8Array(prefix.length + 20 + suffix.length);
+    buffer.set(prefix);
+    let nonce = start;
+    let hashes = 0;
+    let best = 0;
+    let lastReport = Date.now();
+
+    while (true) {
+        const nonces = [];
+        const digests = [];
+        for (let i = 0; i < POPCAP_BATCH; i++) {
+            const digits = String(nonce);
+            let end = prefix.length;
+            for (let j = 0; j < digits.length; j++) {
+                buffer[end++] = digits.charCodeAt(j);
+            }
+            buffer.set(suffix, end);
+            digests.push(crypto.subtle.digest('SHA-256', buffer.subarray(0, end + suffix.length)));
+            nonces.push(nonce);
+            nonce += step;
+        }
+        const results = await Promise.all(digests);
+        hashes += POPCAP_BATCH;
+        for (let i = 0; i < results.length; i++) {
+            const zeroBits = leadingZeroBits(new Uint8Array(results[i]));
+            if (zeroBits > best) {
+                best = zeroBits;
+            }
+            if (zeroBits >= difficulty) {
+                onProgress(hashes, best);
+                return nonces[i];
+            }
+        }
+        if (Date.now() - lastReport >= POPCAP_REPORT_MS) {
+            onProgress(hashes, best);
+            hashes = 0;
+            lastReport = Date.now();
+        }
+    }
+}
+
+// everything a worker needs, built from the functions above so there is only one copy of the search
+function workerSource() {
+    return [
+        `const POPCAP_BATCH = ${POPCAP_BATCH};`,
+        `const POPCAP_REPORT_MS = ${POPCAP_REPORT_MS};`,
+        leadingZeroBits.toString(),
+        searchNonces.toString(),
+        `onmessage = async (event) => {
+            const { captchaToken, difficulty, start, step } = event.data;
+            try {
+                const nonce = await searchNonces(captchaToken, difficulty, start, step,
+                    (hashes, best) => postMessage({ type: 'progress', hashes, best }));
+                postMessage({ type: 'found', nonce });
+            } catch (error) {
+                postMessage({ type: 'error', message: String(error) });
+            }
+        };`,
+    ].join('\n');
 }
 
 document.addEventListener('DOMContentLoaded', function() {
@@ -45,13 +129,16 @@ function setupCaptcha(container) {
             if (!response.ok) {
                 throw new Error(`HTTP error! status: ${response.status}`);
             }
-            const captchaToken = await response.text();
+            // the server picks the difficulty of every captcha, it goes up when it's busy
+            const challenge = await response.json();
+            const captchaToken = challenge.token;
             console.log('Fetched captcha token:', captchaToken);
             const captchaTokenField = document.getElementById("captcha_token");
             captchaTokenField.value = captchaToken;
-            solveProofOfWork(container, captchaToken);
+            await solveProofOfWork(container, captchaToken, challenge.difficulty);
         } catch (error) {
-            console.error('Error fetching captcha token:', error);
+            console.error('Error solving captcha:', error);
+            infoText.style.display = "";
             infoText.textContent = 'Error. Try again?';
         }
     };
@@ -59,69 +146,108 @@ function setupCaptcha(container) {
     solveAndFetch();
 }
 
-function solveProofOfWork(container, captchaToken) {
+// Runs the search on `workers` Web Workers, or on the page if they can't be started.
+// Returns: the nonce
+function findNonce(captchaToken, difficulty, workers, onProgress) {
+    let source = null;
+    try {
+        source = URL.createObjectURL(new Blob([workerSource()], { type: 'text/javascript' }));
+    } catch (error) {
+        console.warn('popcap: no blob urls, solving on the page', error);
+    }
+
+    return new Promise((resolve, reject) => {
+        const running = [];
+        let finished = false;
+        const stopAll = () => {
+            running.forEach(worker => worker.terminate());
+            running.length = 0;
+            if (source) {
+                URL.revokeObjectURL(source);
+                source = null;
+            }
+        };
+        // e.g. a content security policy without blob: workers, or no crypto.subtle in workers
+        const solveOnPage = (error) => {
+            if (finished) {
+                return;
+            }
+            finished = true;
+            console.warn('popcap: solving on the page instead of in workers', error);
+            stopAll();
+            searchNonces(captchaToken, difficulty, 0, 1, onProgress).then(resolve, reject);
+        };
+        try {
+            if (!source || typeof Worker === 'undefined') {
+                throw new Error('Web Workers are not available');
+            }
+            for (let i = 0; i < workers; i++) {
+                const worker = new Worker(source);
+                worker.onmessage = (event) => {
+                    if (event.data.type === 'progress') {
+                        onProgress(event.data.hashes, event.data.best);
+                    } else if (event.data.type === 'error') {
+                        solveOnPage(new Error(`popcap worker failed: ${event.data.message}`));
+                    } else if (event.data.type === 'found' && !finished) {
+                        finished = true;
+                        stopAll();
+                        resolve(event.data.nonce);
+                    }
+                };
+                worker.onerror = (event) => solveOnPage(new Error(`popcap worker failed: ${event.message}`));
+                running.push(worker);
+                worker.postMessage({ captchaToken, difficulty, start: i, step: workers });
+            }
+        } catch (error) {
+            solveOnPage(error);
+        }
+    });
+}
+
+async function solveProofOfWork(container, captchaToken, difficulty) {
     console.log('Starting Proof-of-Work...');
-    const difficulty = 15;
 
+    const workers = Number(container.dataset.workers) || Math.min(navigator.hardwareConcurrency || 2, 8);
     console.log(`Captcha Token: ${captchaToken}`);
-    console.log(`Target Difficulty: ${difficulty}`);
+    console.log(`Target Difficulty: ${difficulty}, ${workers} workers`);
 
-    let nonce = 0;
-    let hash = '';
     const startTime = Date.now();
-    const maxIterations = 10000000;
     let iterations = 0;
     let bestIteration = 0;
     const infoText = document.getElementById('popcap-info');
 
-    async function performHashStep() {
-        if (iterations >= maxIterations) {
-            console.error('Max iterations reached. Captcha could not be solved within limits.');
-            return;
-        }
-        const dataToHash = "popcap-" + captchaToken + "-popcap-" + nonce + "-popcap";
-
-        // hash = MD5(dataToHash);
-        hash = await generateSHA256Hash(dataToHash);
-
-        const totalZeroCount = (hash.match(/0/g) || []).length;
-        if(totalZeroCount > bestIteration) {
-            bestIteration = totalZeroCount;
-
-            // purely aesthetic, can leave out if you need performance for one more difficulty
-            const rollingDuration = (Date.now() - startTime) / 1000;
-            const speedKHS = ((iterations / (rollingDuration > 0 ? rollingDuration : 0.001)) / 1000).toFixed();
-            infoText.textContent = `popcap: loading captcha... ${bestIteration}/${difficulty} ${speedKHS} kH/s`;
-        }
-
-        if (totalZeroCount >= difficulty) {
-            const endTime = Date.now();
-            const duration = (endTime - startTime) / 1000;
-            console.log(`Captcha solved! Nonce: ${nonce}, Hash: ${hash}`);
-            console.log(`Time taken: ${duration.toFixed(2)} seconds`);
-            console.log(`Speed: ${(iterations / duration).toFixed(2)} H/s`);
-
-            const infoText = document.getElementById('popcap-info');
-            infoText.textContent = 'Captcha Solved!';
-            infoText.style.display = "none";
-
-            const imageUrl = `/popcap/wave2?challenge_token=${encodeURIComponent(captchaToken)}&nonce=${encodeURIComponent(nonce)}`;
-            const imgElement = document.createElement('img');
-            imgElement.src = imageUrl;
-            imgElement.classList.add("justify-center");
-            imgElement.classList.add("rounded-xl");
-            imgElement.style.width = "200px";
-            imgElement.style.height = "80px";
-
-            container.appendChild(imgElement);
-
-
-        } else {
-            nonce++;
-            iterations++;
-            // NEVER USE requestAnimationFrame IT DOESNT WORK
-            setTimeout(performHashStep, 0); 
-        }
+    const nonce = await findNonce(captchaToken, difficulty, workers, (hashes, best) => {
+        iterations += hashes;
+        bestIteration = Math.max(bestIteration, best);
+        const rollingDuration = (Date.now() - startTime) / 1000;
+        const speedKHS = ((iterations / (rollingDuration > 0 ? rollingDuration : 0.001)) / 1000).toFixed();
+        infoText.textContent = `popcap: loading captcha... ${bestIteration}/${difficulty} ${speedKHS} kH/s`;
+    });
+
+    const duration = (Date.now() - startTime) / 1000;
+    console.log(`Captcha solved! Nonce: ${nonce}`);
+    console.log(`Time taken: ${duration.toFixed(2)} seconds`);
+    console.log(`Speed: ${(iterations / (duration > 0 ? duration : 0.001)).toFixed(2)} H/s`);
+
+    infoText.textContent = 'Captcha Solved!';
+    infoText.style.display = "none";
+
+    const imageUrl = `/popcap/wave2?challenge_token=${encodeURIComponent(captchaToken)}&nonce=${encodeURIComponent(nonce)}`;
+    const imageResponse = await fetch(imageUrl);
+    if (!imageResponse.ok || imageResponse.headers.get('Content-Type') !== 'image/png') {
+        throw new Error(`wave 2 refused the proof, status ${imageResponse.status}`);
     }
-    performHashStep();
-}
\ No newline at end of file
+    // the form has to send the token wave 2 hands back, signed captchas get a new one here
+    const nextToken = imageResponse.headers.get('X-Popcap-Token');
+    if (nextToken) {
+        document.getElementById("captcha_token").value = nextToken;
+    }
+    const imgElement = document.createElement('img');
+    imgElement.src = URL.createObjectURL(await imageResponse.blob());
+    imgElement.classList.add("justify-center");
+    imgElement.classList.add("rounded-xl");
+    imgElement.style.width = "200px";
+    imgElement.style.height = "80px";
+
+    container.appendChild(imgElement);
+}
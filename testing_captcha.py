@@ -1,87 +1,224 @@
+"""
+Popcap proof-of-work solver, for testing, load tests and picking difficulties.
+
+    python testing_captcha.py solve <token> --difficulty 16
+    python testing_captcha.py live --url http://127.0.0.1:8080 --rounds 5
+    python testing_captcha.py calibrate --difficulties 12-20 --samples 30
+
+solve:     find a nonce for one token.
+live:      run whole captchas against a running onepop: /popcap/wave1, solve, /popcap/wave2.
+calibrate: solve random tokens at every difficulty and report how long it took
+           (median, p90, p99, worst), so difficulty targets can come from data.
+
+Nonce ranges are split across a process pool (--processes, default one per
+core). Every worker hashes the constant "popcap-<token>-popcap-" prefix once
+and copies that state for each nonce, and checks the raw digest instead of
+a hex string. Stdlib only, so it runs anywhere without onepop's requirements.
+"""
+import argparse
+import concurrent.futures
 import hashlib
+import json
+import os
+import statistics
+import sys
 import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
 
-def generate_sha256_hash(data):
-    """Generates the SHA-256 hash of the input data."""
-    sha256 = hashlib.sha256()
-    sha256.update(data.encode('utf-8'))
-    return sha256.hexdigest()
+CHUNK = 1 << 16 # nonces per task, a few tenths of a second per core
 
-def solve_proof_of_work(captcha_token):
+def leading_zero_bits(digest):
+    """Number of zero bits at the start of the digest, same as helpers.leading_zero_bits."""
+    return len(digest) * 8 - int.from_bytes(digest, "big").bit_length()
+
+def target(difficulty):
+    """
+    Digests below this (compared as bytes, which for equal lengths is numeric order)
+    start with `difficulty` zero bits.
     """
-    Solves a simple Proof-of-Work challenge similar to the provided JavaScript.
+    return (1 << (256 - difficulty)).to_bytes(32, "big")
 
-    Args:
-        captcha_token: The token required for the proof-of-work.
+def search(captcha_token, difficulty, start, count):
+    """
+    Try the nonces start .. start + count - 1.
 
     Returns:
-        The nonce if the challenge is solved, otherwise None.
+        (nonce or None, number of hashes computed)
     """
-    print('Starting Proof-of-Work...')
-    if not captcha_token:
-        print('Error: Captcha token not found.')
-        return None
-
-    difficulty = 14
-
-    print(f'Captcha Token: {captcha_token}')
-    print(f'Target Difficulty: {difficulty}')
-
-    nonce = 0
-    hash_val = ''
-    start_time = time.time()
-    max_iterations = 10000000
-    iterations = 0
-    best_iteration = 0
-
-    while iterations < max_iterations:
-        data_to_hash = f"popcap-{captcha_token}-popcap-{nonce}-popcap"
-        hash_val = generate_sha256_hash(data_to_hash)
-
-        # Count leading zeros in the hash (hexadecimal representation)
-        # Each hex character can represent 4 bits. To check for a certain number of
-        # leading zero *bits*, we need to check the hex characters.
-        # A '0' hex character means 4 zero bits.
-        # A '1' to '7' hex character means fewer than 4 zero bits at the beginning.
-        # To simplify for this example based on the JS which likely checks leading '0' characters,
-        # we will count the number of leading '0' characters in the hex string.
-        total_zero_count = hash_val.count('0')
-
-        if total_zero_count > best_iteration:
-            best_iteration = total_zero_count
-            elapsed_time = time.time() - start_time
-            # Avoid division by zero if duration is 0
-            hash_rate = (iterations / elapsed_time) if elapsed_time > 0 else 0
-            print(f'Solving... {best_iteration}/{difficulty} {int(hash_rate / 1000)}kH/s')
-
-
-        if total_zero_count >= difficulty:
-            end_time = time.time()
-            duration = end_time - start_time
-            print(f'Captcha solved! Nonce: {nonce}, Hash: {hash_val}')
-            print(f'Time taken: {duration:.2f} seconds')
-            print(f'Speed: {iterations / duration:.2f} H/s')
-            return nonce
-
-        nonce += 1
-        iterations += 1
-        # In a real-world scenario, you might add a small delay here
-        # to avoid pegging the CPU, similar to setTimeout(..., 0)
-        # time.sleep(0) # Uncomment for a slight pause if needed
-
-    print('Max iterations reached. Captcha could not be solved within limits.')
-    return None
-
-# --- Testing Implementation ---
-if __name__ == "__main__":
-    # Replace with a sample captcha token for testing
-    test_captcha_token = "8430d8ba-6756-46be-942e-f6b826264338"
+    if difficulty <= 0:
+        return start, 0 # anything goes, e.g. POPCAP_TEST_MODE
+    prefix = hashlib.sha256(f"popcap-{captcha_token}-popcap-".encode())
+    below = target(difficulty)
+    for nonce in range(start, start + count):
+        state = prefix.copy()
+        state.update(b"%d-popcap" % nonce)
+        if state.digest() < below:
+            return nonce, nonce - start + 1
+    return None, count
+
+class Solver():
+    """
+    Process pool that searches nonce ranges in parallel.
 
-    solved_nonce = solve_proof_of_work(test_captcha_token)
+    Args:
+        processes: worker processes, 1 searches in this process without a pool.
+    """
+    def __init__(self, processes=None):
+        self.processes = processes or os.cpu_count() or 1
+        self.pool = None
+        if self.processes > 1:
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.processes)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+
+    def solve(self, captcha_token, difficulty, max_hashes=1 << 34):
+        """
+        Returns:
+            (nonce as a string or None if max_hashes ran out, hashes computed, seconds)
+        """
+        started = time.perf_counter()
+        hashes = 0
+        if self.pool is None:
+            for start in range(0, max_hashes, CHUNK):
+                nonce, done = search(captcha_token, difficulty, start, CHUNK)
+                hashes += done
+                if nonce is not None:
+                    return str(nonce), hashes, time.perf_counter() - started
+            return None, hashes, time.perf_counter() - started
+
+        # keep every core busy with a queue of ranges, take the first nonce that turns up
+        next_start = 0
+        pending = set()
+        found = None
+        while found is None and (pending or next_start < max_hashes):
+            while len(pending) < self.processes * 2 and next_start < max_hashes:
+                pending.add(self.pool.submit(search, captcha_token, difficulty, next_start, CHUNK))
+                next_start += CHUNK
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                nonce, count = future.result()
+                hashes += count
+                if nonce is not None and (found is None or nonce < found):
+                    found = nonce
+        for future in pending:
+            future.cancel()
+        return (str(found) if found is not None else None), hashes, time.perf_counter() - started
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def solve_command(args, solver):
+    nonce, hashes, seconds = solver.solve(args.token, args.difficulty)
+    if nonce is None:
+        print("No nonce found.")
+        return 1
+    digest = hashlib.sha256(f"popcap-{args.token}-popcap-{nonce}-popcap".encode()).digest()
+    print(f"nonce {nonce}, hash {digest.hex()} ({leading_zero_bits(digest)} zero bits)")
+    print(f"{hashes} hashes in {seconds:.2f}s, {hashes / max(seconds, 1e-9) / 1000:.0f} kH/s on {solver.processes} processes")
+    return 0
+
+def live_command(args, solver):
+    """
+    Whole captchas against a running server. Only the wave 2 image stays unsolved,
+    that one is for humans (or POPCAP_TEST_SOLUTION in test mode).
+    """
+    base = args.url.rstrip("/")
+    failures = 0
+    for round_number in range(1, args.rounds + 1):
+        try:
+            started = time.perf_counter()
+            with urllib.request.urlopen(base + "/popcap/wave1", timeout=30) as response:
+                challenge = json.load(response)
+            wave1_seconds = time.perf_counter() - started
+
+            nonce, hashes, solve_seconds = solver.solve(challenge["token"], challenge["difficulty"])
+
+            started = time.perf_counter()
+            query = urllib.parse.urlencode({"challenge_token": challenge["token"], "nonce": nonce})
+            with urllib.request.urlopen(f"{base}/popcap/wave2?{query}", timeout=30) as response:
+                image = response.read()
+                content_type = response.headers.get("Content-Type")
+                form_token = response.headers.get("X-Popcap-Token") or challenge["token"]
+            wave2_seconds = time.perf_counter() - started
+        except (urllib.error.URLError, OSError, ValueError, KeyError) as e:
+            # 429 from the rate limiter ends up here too
+            print(f"round {round_number}: failed: {e}")
+            failures += 1
+            continue
+
+        if content_type != "image/png":
+            print(f"round {round_number}: wave 2 refused the proof: {image[:100]!r}")
+            failures += 1
+            continue
+        if args.save:
+            os.makedirs(args.save, exist_ok=True)
+            with open(os.path.join(args.save, f"captcha-{round_number}.png"), "wb") as f:
+                f.write(image)
+        print(f"round {round_number}: difficulty {challenge['difficulty']}, wave1 {wave1_seconds * 1000:.1f}ms, "
+              f"solve {solve_seconds:.2f}s ({hashes} hashes), wave2 {wave2_seconds * 1000:.1f}ms, "
+              f"form token {form_token[:24]}...")
+    return 1 if failures else 0
+
+def calibrate_command(args, solver):
+    low, _, high = args.difficulties.partition("-")
+    difficulties = range(int(low), int(high or low) + 1)
+    report = []
+    for difficulty in difficulties:
+        times, hashes = [], []
+        for _ in range(args.samples):
+            nonce, count, seconds = solver.solve(str(uuid.uuid4()), difficulty)
+            times.append(seconds)
+            hashes.append(count)
+        times.sort()
+        row = {
+            "difficulty": difficulty,
+            "samples": args.samples,
+            "expected_hashes": 2 ** difficulty,
+            "mean_hashes": round(statistics.mean(hashes)),
+            "p50_s": round(percentile(times, 0.50), 3),
+            "p90_s": round(percentile(times, 0.90), 3),
+            "p99_s": round(percentile(times, 0.99), 3),
+            "max_s": round(times[-1], 3),
+            "khs": round(sum(hashes) / max(sum(times), 1e-9) / 1000),
+        }
+        report.append(row)
+        print(f"difficulty {difficulty:2d}: p50 {row['p50_s']:.3f}s  p90 {row['p90_s']:.3f}s  p99 {row['p99_s']:.3f}s  "
+              f"max {row['max_s']:.3f}s  mean {row['mean_hashes']} hashes  {row['khs']} kH/s", file=sys.stderr)
+    # solve times scale with the hash rate, the hash counts don't: a browser doing
+    # 300 kH/s in total needs mean_hashes / 300000 seconds on average
+    print(json.dumps({"processes": solver.processes, "results": report}, indent=2))
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="solve popcap proofs of work, live or offline")
+    parser.add_argument("--processes", type=int, default=0, help="worker processes, 0 = one per cpu core")
+    commands = parser.add_subparsers(dest="command", required=True)
+    solving = commands.add_parser("solve", help="find a nonce for one token")
+    solving.add_argument("token")
+    solving.add_argument("--difficulty", type=int, required=True, help="leading zero bits, /popcap/wave1 returns it with the token")
+    live = commands.add_parser("live", help="run captchas against a running server")
+    live.add_argument("--url", default="http://127.0.0.1:8080")
+    live.add_argument("--rounds", type=int, default=1)
+    live.add_argument("--save", help="directory to save the wave 2 images in")
+    calibrating = commands.add_parser("calibrate", help="solve time distribution per difficulty, json on stdout")
+    calibrating.add_argument("--difficulties", default="12-20", help="e.g. 16 or 12-20")
+    calibrating.add_argument("--samples", type=int, default=20, help="tokens solved per difficulty")
+    args = parser.parse_args()
+
+    solver = Solver(args.processes or None)
+    try:
+        if args.command == "solve":
+            return solve_command(args, solver)
+        if args.command == "live":
+            return live_command(args, solver)
+        return calibrate_command(args, solver)
+    finally:
+        solver.close()
 
-    if solved_nonce is not None:
-        print(f"Proof-of-Work solved with nonce: {solved_nonce}")
-        # In a real application, you would now submit the nonce
-        # along with the captcha_token to the server for verification.
-    else:
-        print("Proof-of-Work failed.")
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,22 @@
+import os
+import shutil
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import build_static
+
+def test_tailwind_scans_popcap_js():
+    assert f'@source "{os.path.join(build_static.STATIC, "popcap.js")}";' in build_static.tailwind_input()
+
+def test_built_css_has_popcap_classes():
+    # TAILWIND="npx @tailwindcss/cli" to run this without a standalone tailwindcss binary
+    tailwind = os.environ.get("TAILWIND") or shutil.which("tailwindcss")
+    if not tailwind:
+        pytest.skip("no Tailwind CLI, set TAILWIND to the command that runs it")
+    css = build_static.compile_css(tailwind).decode()
+    # what popcap.js adds to the wave 2 image with classList, rounded-xl is used nowhere else
+    assert ".rounded-xl" in css
+    assert ".justify-center" in css
@@ -0,0 +1,54 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import helpers
+from database import Database
+
+def test_signed_captcha_is_spent_in_memory_by_default(tmp_path):
+    database = Database(str(tmp_path / "onepop.db"), captcha_store="signed", captcha_image_pool=0, secret_key=b"secret")
+    try:
+        signer = database.captcha_signer
+        token = signer.issue("captcha-id", helpers.timestamp(), 16, wave=2)
+        answer = signer.solution("captcha-id")
+
+        assert database.captcha_check_wave_2(token, answer)
+        assert not database.captcha_check_wave_2(token, answer)
+        # checking it was cpu work only, nothing went to the database
+        with database.handle() as (conn, cursor):
+            cursor.execute("SELECT COUNT(*) FROM captcha_spent")
+            assert cursor.fetchone() == (0,)
+    finally:
+        database.close()
+
+def test_signed_captcha_is_spent_across_processes(tmp_path):
+    # two Databases on one file, like two of serve.py's workers
+    filename = str(tmp_path / "onepop.db")
+    workers = [Database(filename, captcha_store="signed", captcha_image_pool=0, secret_key=b"shared secret",
+                        captcha_shared_spent=True) for _ in range(2)]
+    try:
+        signer = workers[0].captcha_signer
+        token = signer.issue("captcha-id", helpers.timestamp(), 16, wave=2)
+        answer = signer.solution("captcha-id")
+
+        assert workers[0].captcha_check_wave_2(token, answer)
+        assert not workers[1].captcha_check_wave_2(token, answer)
+        assert not workers[0].captcha_check_wave_2(token, answer)
+    finally:
+        for database in workers:
+            database.close()
+
+def test_spent_buckets_are_purged(tmp_path):
+    database = Database(str(tmp_path / "onepop.db"), captcha_store="signed", captcha_image_pool=0, secret_key=b"secret",
+                        captcha_shared_spent=True)
+    try:
+        spent = database.captcha_signer.spent
+        assert spent.spend("old", 0, 0)
+        # two ttls later nothing issued back then can be checked anymore
+        assert spent.spend("new", 2 * spent.ttl, 2 * spent.ttl)
+        with database.handle() as (conn, cursor):
+            cursor.execute("SELECT captcha_id FROM captcha_spent")
+            assert cursor.fetchall() == [("new",)]
+    finally:
+        database.close()
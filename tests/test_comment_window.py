@@ -0,0 +1,86 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import migrations
+from database import Database
+
+@pytest.fixture
+def database(tmp_path):
+    db = Database(str(tmp_path / "onepop.db"), captcha_image_pool=0)
+    yield db
+    db.close()
+
+def flatten(comments):
+    for comment in comments:
+        yield comment.comment_id
+        yield from flatten(comment.replies)
+
+def read_all(database, post_id, **window):
+    """Follow next_after until the last window, returns the ids in the order they were shown."""
+    seen = []
+    after = None
+    for _ in range(100):
+        comments, after = database.get_comment_window(post_id, after=after, **window)
+        seen.extend(flatten(comments))
+        if after is None:
+            return seen
+    raise AssertionError("comment windows never ended")
+
+def test_capped_window_reaches_every_root(database):
+    post_id = database.new_post("random", "title", "description")
+    expected = []
+    for _ in range(5):
+        root = database.new_comment(post_id, "root")
+        expected.append(root)
+        for _ in range(9):
+            expected.append(database.new_comment(post_id, "reply", parent_comment_id=root))
+
+    # 50 comments over windows of at most 20, roots that got cut off are finished first
+    comments, after = database.get_comment_window(post_id, roots=20, limit=20)
+    assert len(list(flatten(comments))) == 20
+    assert after is not None
+    assert read_all(database, post_id, roots=20, limit=20) == expected
+
+def test_capped_thread_reaches_later_replies(database):
+    post_id = database.new_post("random", "title", "description")
+    r = database.new_comment(post_id, "r")
+    a = database.new_comment(post_id, "a", parent_comment_id=r)
+    a_replies = [database.new_comment(post_id, "reply", parent_comment_id=a) for _ in range(30)]
+    b = database.new_comment(post_id, "b", parent_comment_id=r)
+
+    seen = read_all(database, post_id, thread=r, limit=20)
+    assert seen == [r, a] + a_replies + [b]
+
+def test_upgrade_moves_cross_post_replies_to_their_own_post(tmp_path):
+    # a database from before comment paths, with a reply whose parent is on another post
+    filename = str(tmp_path / "onepop.db")
+    conn = sqlite3.connect(filename)
+    cursor = conn.cursor()
+    for version in range(2):
+        migrations.MIGRATIONS[version](cursor)
+    cursor.execute("PRAGMA user_version = 2")
+    cursor.execute("INSERT INTO boards (board_id, name, description) VALUES (1, 'random', 'anything')")
+    cursor.executemany("INSERT INTO posts (post_id, board_id, title, created_at, updated_at) VALUES (?, 1, 'title', 1, 1)",
+                       [(1,), (2,)])
+    cursor.execute("INSERT INTO comments (comment_id, post_id, content, created_at, updated_at) VALUES (1, 1, 'root', 1, 1)")
+    cursor.execute("""INSERT INTO comments (comment_id, post_id, parent_comment_id, content, created_at, updated_at)
+                      VALUES (2, 2, 1, 'reply from another post', 2, 2)""")
+    conn.commit()
+    conn.close()
+
+    database = Database(filename, captcha_image_pool=0)
+    try:
+        comments, after = database.get_comment_window(2)
+        assert [comment.comment_id for comment in comments] == [2]
+        assert comments[0].parent_comment_id is None
+        comments, after = database.get_comment_window(1)
+        assert comments[0].reply_count == 0 and comments[0].replies == []
+        page = database.load_post_page(2)
+        assert page.post.comment_count == 1 and len(page.comments) == 1
+    finally:
+        database.close()
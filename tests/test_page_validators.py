@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import helpers
+import main
+
+@pytest.fixture
+def app(tmp_path):
+    app = main.create_app({"DATABASE": str(tmp_path / "onepop.db"), "CAPTCHA_IMAGE_POOL": 0})
+    yield app
+    app.extensions["onepop.database"].close()
+
+def test_no_validators_until_writes_of_that_second_committed(app, monkeypatch):
+    monkeypatch.setattr(helpers, "timestamp", lambda: 1000)
+    with app.test_request_context("/"):
+        # a write stamped 999 may still be committing in second 1000
+        assert main.page_validators("post", 1, 1000) == (None, None)
+        assert main.page_validators("post", 1, 999) == (None, None)
+        etag, last_modified = main.page_validators("post", 1, 1000 - main.WRITE_SETTLE_SECONDS - 1)
+        assert etag is not None
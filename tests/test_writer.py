@@ -0,0 +1,33 @@
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import metrics
+from writer import Writer
+
+def observations(histogram):
+    # every slot but the sum at the end
+    return sum(sum(series[:-1]) for series in histogram.series.values())
+
+def test_writes_count_for_the_request(tmp_path):
+    filename = str(tmp_path / "writer.db")
+    with sqlite3.connect(filename) as conn:
+        conn.execute("CREATE TABLE t (x INTEGER)")
+    writer = Writer(lambda: sqlite3.connect(filename, check_same_thread=False))
+    batches = observations(metrics.writer_batch_seconds)
+    try:
+        metrics.start_request()
+        writer.submit(lambda cursor: cursor.execute("INSERT INTO t (x) VALUES (1)"))
+        writer.submit(lambda cursor: cursor.executemany("INSERT INTO t (x) VALUES (?)", [(2,), (3,)]))
+        statements, seconds = metrics._current.stats
+        metrics.finish_request("test", "POST", 200)
+    finally:
+        writer.stop()
+
+    # two inserts plus the savepoint around each job, all from the writer thread
+    assert statements == 6
+    assert seconds > 0
+    assert observations(metrics.writer_batch_seconds) >= batches + 1
+    assert "onepop_writer_batch_jobs_count" in metrics.render()
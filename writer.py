@@ -0,0 +1,141 @@
+"""
+Single writer with group commit.
+
+All writes of a server process go through one thread that owns the only
+writing connection. Callers hand it a function that does the writes with a
+cursor and wait for the result. Whatever queued up while the previous batch
+was committing runs together in one transaction, so a burst of comments
+pays for one commit instead of one each, and writers of the same process
+never fight over sqlite's lock. Readers keep using the pooled connections.
+
+Every job runs inside its own savepoint: a job that raises is rolled back
+alone and its caller gets the exception, the rest of the batch still commits.
+"""
+import queue
+import threading
+import time
+
+import metrics
+
+class WriteJob():
+    __slots__ = ("fn", "args", "done", "result", "error", "stats")
+
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.stats = [0, 0.0] # sql statements and seconds of this job, like metrics counts them for requests
+
+class Writer():
+    """
+    connect: returns a new sqlite3 connection, the writer thread opens it on start
+    max_batch: most jobs committed in one transaction
+    """
+    def __init__(self, connect, max_batch=64):
+        self.connect = connect
+        self.max_batch = max_batch
+        self.jobs = queue.Queue()
+        self.thread = None
+        self.stopped = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        # started on first use rather than in __init__, so every forked server process gets its own thread
+        with self.lock:
+            if self.stopped:
+                raise RuntimeError("writer: already stopped")
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="onepop-writer", daemon=True)
+                self.thread.start()
+
+    def submit(self, fn, *args):
+        """
+        Run fn(cursor, *args) on the writer thread and wait until it's committed.
+        Returns: what fn returned. Raises whatever fn raised, or the commit's error.
+        """
+        self.start()
+        job = WriteJob(fn, args)
+        started = time.perf_counter()
+        self.jobs.put(job)
+        job.done.wait()
+        metrics.writer_wait_seconds.observe(time.perf_counter() - started)
+        # the request's sql metrics count its writes too
+        metrics.add_queries(job.stats)
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def stop(self):
+        """
+        Finish the queued jobs and close the connection.
+        """
+        with self.lock:
+            self.stopped = True
+            thread = self.thread
+        if thread is not None and thread.is_alive():
+            self.jobs.put(None)
+            thread.join()
+
+    def run(self):
+        conn = self.connect()
+        # transactions are managed by hand here
+        conn.isolation_level = None
+        cursor = conn.cursor(metrics.TimedCursor) if metrics.enabled else conn.cursor()
+        running = True
+        while running:
+            batch = [self.jobs.get()]
+            # take everything that piled up in the meantime, up to max_batch
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = [job for job in batch if job is not None]
+                # jobs that raced stop() still get their answer
+                while True:
+                    try:
+                        job = self.jobs.get_nowait()
+                    except queue.Empty:
+                        break
+                    if job is not None:
+                        batch.append(job)
+            if batch:
+                self.commit(conn, cursor, batch)
+        conn.close()
+
+    def commit(self, conn, cursor, batch):
+        started = time.perf_counter()
+        try:
+            # IMMEDIATE takes the write lock up front, waiting out other processes through the busy timeout
+            cursor.execute("BEGIN IMMEDIATE")
+            for job in batch:
+                metrics.count_queries(job.stats)
+                try:
+                    cursor.execute("SAVEPOINT job")
+                    try:
+                        job.result = job.fn(cursor, *job.args)
+                    except Exception as e:
+                        job.error = e
+                        cursor.execute("ROLLBACK TO job")
+                    cursor.execute("RELEASE job")
+                finally:
+                    metrics.count_queries(None)
+            cursor.execute("COMMIT")
+            metrics.writer_batch_jobs.observe(len(batch))
+            metrics.writer_batch_seconds.observe(time.perf_counter() - started)
+        except Exception as e:
+            # the transaction itself failed (locked, disk full, ...), nothing of the batch was committed
+            print(f"writer: batch of {len(batch)} jobs failed: {e}")
+            if conn.in_transaction:
+                conn.rollback()
+            for job in batch:
+                job.result = None
+                if job.error is None:
+                    job.error = e
+        finally:
+            for job in batch:
+                job.done.set()